@@ -2,38 +2,196 @@
 # Module holds the class => APICallManager - manages the api interface to fetch both the parent company id and the
 # provider id for a given study id.
 # Class responsible for all api related interactions with both the study builder and the odc account service including
-# the api call, data fetch, json file dict read and search for data collection
+# the api call, data fetch, json file dict read and search for data collection. All calls share one pooled http session,
+# a batch of study numbers is resolved concurrently over that pool. Each call has separate connect and read timeouts
+# and a failed call is retried with a jittered backoff, or after the server's Retry-After for a 429. A 404 is the answer
+# for an unknown study, any other status but 200 is a failed call. A circuit breaker opens once the error rate of the
+# recent calls crosses a threshold, every later call of the run then fails fast with StudyBuilderUnavailable.
 #
 #import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import asyncio
+import random
 import requests
 import logging
+import threading
+import time
+
+from metrics_manager import metrics
+from throttle_manager import retry_after
+
+
+# Raised in place of a Study Builder call while the circuit breaker is open
+#
+class StudyBuilderUnavailable(Exception):
+    pass
 
 
 class APICallManager(object):
-    def __init__(self):
+    def __init__(self, concurrency=8, connect_timeout=5, read_timeout=30, retries=2, backoff=0.5, error_rate=0.5,
+                 min_calls=10, window=20):
         self.key_id = 'id'
         self.key_name = 'name'
         self.key_campaigns = 'campaigns'
         self.start_date = 'startDate'
         self.end_date = 'endDate'
+        self.concurrency = concurrency
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_retry_after = 60               # longest Retry-After wait honoured, in seconds
+        self.answer_status = (200, 404)         # a real answer for the study, the only results that may be cached
+        # circuit breaker -> opens when at least min_calls of the last window calls were made and error_rate of them
+        # failed, then stays open for the rest of the run
+        self.breaker_error_rate = float(error_rate)
+        self.breaker_min_calls = int(min_calls)
+        self.breaker_calls = deque(maxlen=max(int(window), int(min_calls)))
+        self.breaker_open = False
+        self.breaker_lock = threading.Lock()
+        self.stats = dict()
+        self.reset_breaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.logger = logging.getLogger(__name__)
 
-    # Launch the api call to return a json dictionary to be searched for required data
+    # Launch the api call to return a json dictionary to be searched for required data, returns (http status, json
+    # dictionary). A 404 answer returns (404, None) and a failed call (None, None). A timeout, connection error, 429
+    # or server error is retried, any other error status is not. Raises StudyBuilderUnavailable while the circuit
+    # breaker is open
     #
     def api_call(self, api_url, arg):
+        for attempt in range(self.retries + 1):
+            if self.breaker_open:
+                with self.breaker_lock:
+                    self.stats['rejected'] += 1
+                metrics.count('study_builder.rejected')
+                raise StudyBuilderUnavailable("Study Builder circuit breaker is open")
+            try:
+                metrics.count('study_builder.call')
+                with metrics.span('study builder call'):
+                    response = self.session.get("{}{}".format(api_url, arg), timeout=self.timeout)
+                    if response.status_code == 404:
+                        # the study does not exist, an answer rather than a failure
+                        self.call_outcome(True)
+                        return response.status_code, None
+                    response.raise_for_status()
+                    if response.status_code != 200:
+                        raise requests.HTTPError("Unexpected status {}".format(response.status_code),
+                                                 response=response)
+                    call_dict = response.json()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                self.call_outcome(False)
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and status < 500 and status != 429:
+                    self.logger.error("Study Builder call for %s refused => %s", arg, e)
+                    break
+                if attempt == self.retries:
+                    self.logger.error("Failed to create a response object after %s retries => %s", self.retries, e)
+                    break
+                delay = retry_after(e.response) if status == 429 else None
+                if delay is None:
+                    delay = random.uniform(0, self.backoff * 2 ** attempt)
+                delay = min(delay, self.max_retry_after)
+                self.logger.warning("Study Builder call for %s failed, retry %s in %.2fs => %s",
+                                    arg, attempt + 1, delay, e)
+                metrics.count('study_builder.retry')
+                time.sleep(delay)
+            except Exception as e:
+                self.call_outcome(False)
+                self.logger.error("Failed to create a response object => %s", e)
+                break
+            else:
+                self.call_outcome(True)
+                return response.status_code, call_dict
+        if self.breaker_open:
+            raise StudyBuilderUnavailable("Study Builder circuit breaker is open")
+        return None, None
+
+    # Records the outcome of a call attempt, opening the circuit breaker once the recent error rate crosses the
+    # threshold
+    #
+    def call_outcome(self, success):
+        with self.breaker_lock:
+            self.breaker_calls.append(success)
+            self.stats['calls'] += 1
+            if not success:
+                self.stats['failures'] += 1
+            if self.breaker_open or len(self.breaker_calls) < self.breaker_min_calls:
+                return
+            error_rate = self.breaker_calls.count(False) / float(len(self.breaker_calls))
+            if error_rate < self.breaker_error_rate:
+                return
+            self.breaker_open = True
+        self.logger.error("Study Builder circuit breaker open, %.0f%% of the last %s calls failed, the remaining calls "
+                          "of this run are deferred", error_rate * 100, len(self.breaker_calls))
+        metrics.count('study_builder.breaker_opened')
+
+    # Closes the circuit breaker and starts the counts over, at the start of each run
+    #
+    def reset_breaker(self):
+        with self.breaker_lock:
+            self.breaker_calls.clear()
+            self.breaker_open = False
+            self.stats = {"calls": 0, "failures": 0, "rejected": 0}
+
+    # Returns the call counts of the run with the breaker state
+    #
+    def breaker_stats(self):
+        with self.breaker_lock:
+            return dict(self.stats, breaker_open=self.breaker_open)
+
+    # Makes a batch call, a call refused by the open circuit breaker is returned as a failed call
+    #
+    def batch_call(self, api_url, arg):
         try:
-            response = requests.get("{}{}".format(api_url, arg))
-        except Exception as e:
-            self.logger.error("Failed to create a response object => {}".format(e))
-            return None
-        else:
-            call_dict = response.json()
-            return call_dict
+            return self.api_call(api_url, arg)
+        except StudyBuilderUnavailable:
+            return None, None
+
+    # Resolves a batch of study numbers to their parent company ids, the api calls run concurrently over the pooled
+    # session with at most 'concurrency' in flight. Returns a dict of study number -> parent company id for the studies
+    # answered with a 200 or a 404, a study that returned no parent company id or is not found maps to None and a
+    # study whose call failed is left out
+    #
+    def parent_id_batch(self, api_url, study_numbers):
+        return asyncio.run(self.parent_id_gather(api_url, list(study_numbers)))
+
+    async def parent_id_gather(self, api_url, study_numbers):
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.concurrency)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='StudyBuilder') as executor:
+            async def fetch(study_number):
+                async with limit:
+                    status, call_dict = await loop.run_in_executor(executor, self.batch_call, api_url,
+                                                                   study_number)
+                return study_number, status, call_dict
+
+            results = await asyncio.gather(*(fetch(study_number) for study_number in study_numbers))
+
+        return dict((study_number, self.parent_id_fetch(call_dict)) for study_number, status, call_dict in results
+                    if status in self.answer_status)
+
+    # Closes the pooled http session
+    #
+    def close_session(self):
+        self.session.close()
+
+    # Opens a pooled connection to the api host ahead of the first call, any http response shows the host is reachable
+    #
+    def connect(self, api_url, timeout):
+        self.session.head(api_url, timeout=timeout, allow_redirects=False)
 
     # Returns the parent company id value from api return json dict
     #
     @staticmethod
     def parent_id_fetch(call_dict):
+        if not isinstance(call_dict, dict):
+            return None
         parent_company_id = call_dict.get('parentCompanyId')
         return parent_company_id
 
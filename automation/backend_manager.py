@@ -0,0 +1,38 @@
+# backend_manager module
+# Module holds the class => BackendManager - loads the automation backends on first use
+# Class responsible for the registry of backend modules -> the Jira tracker, the Study Builder lookup, the ticket data
+# sources and the alert notifications. Only the backends in the configured path are imported, e.g. the mysql connector
+# is never imported in Excel mode, and each import is timed as a startup cost in the run metrics.
+#
+import importlib
+import logging
+import threading
+
+from metrics_manager import metrics
+
+
+class BackendManager(object):
+    def __init__(self):
+        self.registry = {
+            'tracker':          {'jira': 'jira_manager'},
+            'study_lookup':     {'study_builder': 'api_manager'},
+            'data_source':      {'1': 'excel_manager', '2': 'mysql_manager'},
+            'notification':     {'smtp': 'email_manager'}
+        }
+        self.modules = dict()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    # Returns the module of a backend, imported on the first request
+    #
+    def load(self, kind, name):
+        try:
+            module_name = self.registry[kind][name]
+        except KeyError:
+            raise ValueError("Unknown {} backend '{}'".format(kind, name))
+        with self.lock:
+            if module_name not in self.modules:
+                with metrics.startup_span('import {}'.format(module_name)):
+                    self.modules[module_name] = importlib.import_module(module_name)
+                self.logger.info("Loaded the %s backend '%s' from %s", kind, name, module_name)
+            return self.modules[module_name]
@@ -0,0 +1,258 @@
+# benchmark module
+# Offline load test of the automation, FieldInputManager.process_manager is run end-to-end against the local stand-ins
+# of fake_services -> Jira, Study Builder, SMTP and MySQL, with configurable latency and error injection. Synthetic
+# workloads of 100, 1k and 10k tickets are generated, each run in its own process, and the wall time, requests per
+# stage, ticket outcomes and peak RSS of each are reported.
+#
+# Run from the automation directory, e.g.
+#   python benchmark/benchmark.py --tickets 100 1000 10000 --workers 4 --jira-latency 0.02 --output bench.json
+#
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+# Read the benchmark options
+#
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Field Input Automation - offline load test')
+    parser.add_argument('--tickets', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='ticket workload sizes, each run in its own process')
+    parser.add_argument('--data-source', choices=['1', '2'], default='1',
+                        help='1: excel file, 2: mysql table (sqlite stand-in)')
+    parser.add_argument('--workers', type=int, default=None, help='tickets processed concurrently, config.ini default')
+    parser.add_argument('--search-mode', choices=['separate', 'combined'], default=None)
+    parser.add_argument('--alert-mode', choices=['ticket', 'digest'], default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    for service in ('jira', 'api', 'smtp', 'db'):
+        parser.add_argument('--{}-latency'.format(service), type=float, default=0.0,
+                            help='seconds added to each {} request'.format(service))
+        parser.add_argument('--{}-errors'.format(service), type=float, default=0.0,
+                            help='fraction of {} requests answered with an error'.format(service))
+    parser.add_argument('--jira-error-status', type=int, default=500,
+                        help='http status of an injected Jira error, e.g. 503 or 429')
+    parser.add_argument('--output', help='write the reports to this json file')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# Generate a synthetic workload -> the Jira tickets, the Study Builder parent ids, the spreadsheet rows and the
+# assignments table rows. About 1 in 20 accounts has no spreadsheet row and 1 in 50 studies is unknown to Study Builder,
+# so that each workload also exercises the alert path
+#
+def build_workload(size, seed):
+    rng = random.Random(seed)
+    accounts = list()
+    for a in range(max(10, size // 20)):
+        accounts.append({
+            "advertiser":       'Advertiser {:05d}'.format(a),
+            "pid":              50000 + a,
+            "account_type":     'Core Brands' if a % 4 == 0 else 'Enterprise',
+            "listed":           a % 20 != 19
+        })
+    youtube = {"advertiser": 'Pepsico', "pid": 49999, "account_type": 'Enterprise', "listed": True}
+
+    tickets = list()
+    parent_ids = dict()
+    for i in range(1, size + 1):
+        variety = {0: 'Retail', 1: 'YouTube', 2: 'In-Flight ROI'}.get(i % 10, 'Standard')
+        account = youtube if variety == 'YouTube' else rng.choice(accounts)
+        study_number = 100000 + i
+        if i % 50 != 0:
+            parent_ids[study_number] = account['pid']
+        fields = {
+            "customfield_10414":    account['advertiser'],
+            "customfield_17018":    'https://studybuilder.example.com/studies/{}'.format(study_number),
+            "customfield_17028":    'YouTube' if variety == 'YouTube' else 'Other',
+            "customfield_11492":    account['pid'] if i % 2 == 0 else None,
+            "customfield_12325":    None,
+            "customfield_10100":    {"value": 'Retail' if variety == 'Retail' else 'CPG Brands'},
+            "customfield_10101":    {"value": 'In-Flight ROI' if variety == 'In-Flight ROI' else 'Brand Lift'},
+            "reporter":             {"name": 'app_p_jira_sugar', "key": 'app_p_jira_sugar',
+                                     "displayName": 'Jira Sugar'},
+            "updated":              '2019-10-01T08:00:00.000-0600'
+        }
+        tickets.append({"id": str(10000 + i), "key": 'DC-{}'.format(i), "variety": variety, "status": 'Open',
+                        "fields": fields, "watchers": list(), "updates": 0})
+
+    rows = list()
+    db_rows = list()
+    for account in accounts + [youtube]:
+        if not account['listed']:
+            continue
+        a = account['pid']
+        media_partner = 'YouTube' if account is youtube else None
+        rows.append((account['advertiser'], account['pid'], account['account_type'], media_partner, None,
+                     'mgr{}'.format(a), 'rep{}'.format(a), 'watcher{}'.format(a), None, 'analyst{}'.format(a)))
+        db_rows.append({
+            "account":                      str(account['pid']),
+            "media_partner":                media_partner,
+            "account_type":                 account['account_type'],
+            "solutions_mgr":                'mgr{}'.format(a),
+            "solutions_manager":            'rep{}'.format(a),
+            "client_analytics":             'analyst{}'.format(a),
+            "solutions_leader":             'mgr{}'.format(a),
+            "client_solutions_consultant":  'watcher{}'.format(a),
+            "solutions_ops_owner1":         None,
+            "solutions_ops_owner2":         None
+        })
+    return tickets, parent_ids, rows, db_rows
+
+
+# Write the spreadsheet rows to the 'CPG' sheet of a new workbook
+#
+def write_workbook(file_name, rows):
+    from openpyxl import Workbook
+    wb = Workbook()
+    sheet = wb.active
+    sheet.title = 'CPG'
+    sheet.append(('Advertiser', 'PID', 'Account Type', 'Media Partner', None, 'Solutions Mgr', 'Solutions Manager',
+                  'Watcher', 'Watcher', 'Client Analytics'))
+    for row in rows:
+        sheet.append(row)
+    wb.save(file_name)
+
+
+# Run one workload against freshly started stand-ins and return its report
+#
+def run_workload(args, size):
+    from fake_services import FakeJiraService, FakeStudyBuilderService, FakeSMTPService, FakeMySQLConnector
+    import main
+    from field_input_manager import FieldInputManager
+    from metrics_manager import metrics
+
+    work_dir = tempfile.mkdtemp(prefix='fim_benchmark_')
+    logging.basicConfig(filename=os.path.join(work_dir, 'benchmark.log'), level=logging.INFO,
+                        format='%(asctime)s: %(levelname)-7s: %(name)-30s: %(threadName)-12s: %(message)s')
+    tickets, parent_ids, rows, db_rows = build_workload(size, args.seed)
+
+    jira = FakeJiraService(tickets, args.jira_latency, args.jira_errors, args.jira_error_status, args.seed).start()
+    study_builder = FakeStudyBuilderService(parent_ids, args.api_latency, args.api_errors, seed=args.seed).start()
+    smtp = FakeSMTPService(args.smtp_latency, args.smtp_errors, args.seed).start()
+    db = FakeMySQLConnector(os.path.join(work_dir, 'assignments.sqlite'), args.db_latency, args.db_errors, args.seed)
+    db.load_table('assignments', db_rows)
+    excel_dir = os.path.join(work_dir, 'excel_data')
+    os.mkdir(excel_dir)
+    write_workbook(os.path.join(excel_dir, 'cpg_assignments.xlsx'), rows)
+
+    os.chdir(AUTOMATION_DIR)
+    config, config_params = main.read_config()
+    config_params.update({
+        "data_source":          args.data_source,
+        "jira_url":             jira.url,
+        "jira_token":           ('benchmark', 'benchmark'),
+        "study_url":            study_builder.study_url,
+        "excel_file":           excel_dir,
+        "smtp_host":            smtp.host,
+        "email_to":             'alerts@example.com',
+        "email_from":           'automation@example.com',
+        "email_cc":             'cc@example.com',
+        "watermark_path":       os.path.join(work_dir, 'watermark.json'),
+        "journal_path":         work_dir + os.sep,
+        "metrics_path":         work_dir + os.sep,
+        "study_cache_path":     os.path.join(work_dir, 'study_cache.sqlite')
+    })
+    if args.workers is not None:
+        config_params['workers'] = args.workers
+    if args.search_mode is not None:
+        config_params['jql_search_mode'] = args.search_mode
+    if args.alert_mode is not None:
+        config_params['alert_mode'] = args.alert_mode
+
+    start = time.time()
+    field_input = FieldInputManager(config_params)
+    field_input.db_connector = db
+    field_input.process_manager()
+    field_input.shutdown()
+    wall_time = time.time() - start
+
+    outcomes = dict()
+    for outcome in field_input.ticket_outcomes.values():
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    report = {
+        "tickets":          size,
+        "data_source":      args.data_source,
+        "workers":          config_params['workers'],
+        "search_mode":      config_params['jql_search_mode'],
+        "alert_mode":       config_params['alert_mode'],
+        "wall_time":        round(wall_time, 3),
+        "tickets_per_sec":  round(size / wall_time, 2) if wall_time > 0 else None,
+        "peak_rss_mb":      round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        "outcomes":         outcomes,
+        "jira":             dict(jira.faults.stats(), **jira.ticket_stats()),
+        "study_builder":    study_builder.faults.stats(),
+        "smtp":             smtp.stats(),
+        "mysql":            db.stats(),
+        "stages":           metrics.stage_summary(),
+        "log_file":         os.path.join(work_dir, 'benchmark.log')
+    }
+    for service in (jira, study_builder, smtp):
+        service.stop()
+    return report
+
+
+# Run each workload in its own process so that the peak RSS of one does not carry over to the next
+#
+def run_isolated(args, size):
+    command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--data-source', args.data_source,
+               '--seed', str(args.seed), '--jira-error-status', str(args.jira_error_status)]
+    for option in ('workers', 'search_mode', 'alert_mode'):
+        if getattr(args, option) is not None:
+            command += ['--{}'.format(option.replace('_', '-')), str(getattr(args, option))]
+    for service in ('jira', 'api', 'smtp', 'db'):
+        command += ['--{}-latency'.format(service), str(getattr(args, '{}_latency'.format(service))),
+                    '--{}-errors'.format(service), str(getattr(args, '{}_errors'.format(service)))]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Print the reports as a table, one column per workload
+#
+def print_reports(reports):
+    lines = [('tickets', lambda r: r['tickets']),
+             ('wall time (s)', lambda r: r['wall_time']),
+             ('tickets / s', lambda r: r['tickets_per_sec']),
+             ('peak rss (MB)', lambda r: r['peak_rss_mb'])]
+    stages = list()
+    for service in ('jira', 'study_builder', 'smtp', 'mysql'):
+        for stage in sorted(set(stage for r in reports for stage in r[service]['requests'])):
+            stages.append((service, stage))
+    for service, stage in stages:
+        lines.append(('{} {}'.format(service, stage),
+                      lambda r, service=service, stage=stage: r[service]['requests'].get(stage, 0)))
+    for outcome in sorted(set(outcome for r in reports for outcome in r['outcomes'])):
+        lines.append(('outcome: {}'.format(outcome), lambda r, outcome=outcome: r['outcomes'].get(outcome, 0)))
+
+    print('Field Input Automation benchmark - {}, data source {}, {} worker(s)'
+          .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), reports[0]['data_source'], reports[0]['workers']))
+    for label, value in lines:
+        print('{}{}'.format(label.ljust(36), ''.join(str(value(r)).rjust(12) for r in reports)))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.single is not None:
+        print(json.dumps(run_workload(args, args.single)))
+        return
+
+    reports = [run_isolated(args, size) for size in args.tickets]
+    print_reports(reports)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+# fake_services module
+# Module holds the local stand-ins used by the benchmark for the services the automation talks to
+# FakeJiraService - an http stub of the Jira REST endpoints used by JiraManager, FakeStudyBuilderService - an http
+# stub of the Study Builder study endpoint, FakeSMTPService - an smtp sink, FakeMySQLConnector - an sqlite backed
+# stand-in for mysql.connector. Each counts the requests it serves per stage and can add latency and inject errors.
+#
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import logging
+import random
+import re
+import socketserver
+import sqlite3
+import threading
+import time
+
+import mysql.connector
+
+
+# Module holds the class => FaultInjector - latency and error injection shared by the fakes
+# Class responsible for the per-request delay, the random error decision and the per-stage request counts
+#
+class FaultInjector(object):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = dict()
+        self.errors = dict()
+
+    # Counts a request for the stage, sleeps for the configured latency and returns True when an error is injected
+    #
+    def request(self, stage):
+        with self.lock:
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return fail
+
+    # Returns the request and injected error counts per stage
+    #
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.counts), "errors": dict(self.errors)}
+
+
+# Module holds the class => FakeHTTPService - base class of the http stubs
+# Class responsible for serving the stub on a local port from a background thread, requests are routed to the
+# handle method of the subclass
+#
+class FakeHTTPService(object):
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=500, seed=0):
+        self.faults = FaultInjector(latency, error_rate, seed)
+        self.error_status = error_status
+        self.server = None
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    # Starts the stub on a free local port
+    #
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                service.dispatch(self, 'GET')
+
+            def do_POST(self):
+                service.dispatch(self, 'POST')
+
+            def do_PUT(self):
+                service.dispatch(self, 'PUT')
+
+            def do_DELETE(self):
+                service.dispatch(self, 'DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    # Reads the request, applies the injected faults and writes the response of the subclass handler
+    #
+    def dispatch(self, request, method):
+        parsed = urlparse(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        stage, handler = self.route(method, parsed.path)
+        if handler is None:
+            status, payload = 404, {"errorMessages": ["No stub for {} {}".format(method, parsed.path)]}
+        elif self.faults.request(stage):
+            status, payload = self.error_status, {"errorMessages": ["Injected error"]}
+        else:
+            try:
+                status, payload = handler(parsed.path, parse_qs(parsed.query), json.loads(body) if body else None)
+            except Exception as e:
+                self.logger.error("Stub error for %s %s => %s", method, parsed.path, e)
+                status, payload = 500, {"errorMessages": [str(e)]}
+
+        data = json.dumps(payload).encode() if payload is not None else b''
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            request.send_header('Retry-After', '1')
+        request.end_headers()
+        request.wfile.write(data)
+
+    # Returns the (stage, handler) for a request, overridden by the subclasses
+    #
+    def route(self, method, path):
+        return None, None
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# Module holds the class => FakeJiraService - http stub of the Jira REST api
+# Class responsible for the ticket store and the endpoints used by JiraManager -> server info, field list, search,
+# issue get and update, watchers, transitions and session close. A transitioned ticket leaves the 'Open' result set
+#
+class FakeJiraService(FakeHTTPService):
+    def __init__(self, tickets, latency=0.0, error_rate=0.0, error_status=500, seed=0):
+        FakeHTTPService.__init__(self, latency, error_rate, error_status, seed)
+        self.lock = threading.Lock()
+        self.tickets = dict((ticket['key'], ticket) for ticket in tickets)
+        self.order = sorted(self.tickets, key=self.key_number)
+        self.fields = [
+            {"id": "customfield_10100", "name": "Vertical", "custom": True, "clauseNames": ["vertical"]},
+            {"id": "customfield_10101", "name": "Product", "custom": True, "clauseNames": ["product"]},
+            {"id": "reporter", "name": "Reporter", "custom": False, "clauseNames": ["reporter"]},
+            {"id": "status", "name": "Status", "custom": False, "clauseNames": ["status"]}
+        ]
+        self.routes = [
+            ('GET', r'/rest/api/2/serverInfo$', 'server info', self.server_info),
+            ('GET', r'/rest/api/2/field$', 'field list', self.field_list),
+            ('GET', r'/rest/api/2/search$', 'search', self.search),
+            ('POST', r'/rest/api/2/search$', 'search', self.search),
+            ('GET', r'/rest/api/2/issue/([^/]+)$', 'issue get', self.issue_get),
+            ('PUT', r'/rest/api/2/issue/([^/]+)$', 'issue update', self.issue_update),
+            ('GET', r'/rest/api/2/issue/([^/]+)/watchers$', 'watchers get', self.watchers_get),
+            ('POST', r'/rest/api/2/issue/([^/]+)/watchers$', 'watcher add', self.watcher_add),
+            ('GET', r'/rest/api/2/issue/([^/]+)/transitions$', 'transitions get', self.transitions_get),
+            ('POST', r'/rest/api/2/issue/([^/]+)/transitions$', 'transition', self.transition),
+            ('DELETE', r'/rest/auth/(?:1|latest)/session$', 'session close', self.session_close)
+        ]
+
+    def route(self, method, path):
+        for route_method, pattern, stage, handler in self.routes:
+            if route_method == method and re.match(pattern, path):
+                return stage, handler
+        return None, None
+
+    @staticmethod
+    def key_number(key):
+        return int(key.rpartition('-')[2])
+
+    @staticmethod
+    def path_key(path):
+        return path.split('/')[5]
+
+    def server_info(self, path, query, body):
+        return 200, {"baseUrl": self.url, "version": "7.13.0", "versionNumbers": [7, 13, 0],
+                     "deploymentType": "Server", "serverTitle": "Fake Jira"}
+
+    def field_list(self, path, query, body):
+        return 200, self.fields
+
+    # Returns the tickets matching the variety of the jql query, keyset paged on 'key > X' in key order
+    #
+    def search(self, path, query, body):
+        params = body if body is not None else dict((k, v[0]) for k, v in query.items())
+        jql = params.get('jql', '')
+        max_results = int(params.get('maxResults', 50))
+        start_at = int(params.get('startAt', 0))
+        after = re.search(r'key > [A-Z]+-(\d+)', jql)
+        after = int(after.group(1)) if after else 0
+        varieties = self.jql_varieties(jql)
+        with self.lock:
+            matched = [self.tickets[key] for key in self.order
+                       if self.key_number(key) > after and self.tickets[key]['status'] == 'Open' and
+                       self.tickets[key]['variety'] in varieties]
+            page = [self.issue_json(ticket) for ticket in matched[start_at:start_at + max_results]]
+        return 200, {"startAt": start_at, "maxResults": max_results, "total": len(matched), "issues": page}
+
+    # Ticket varieties selected by a jql query, following the predicates of JiraManager.search_tickets
+    #
+    @staticmethod
+    def jql_varieties(jql):
+        if ' OR ' in jql:
+            return {'Standard', 'YouTube', 'In-Flight ROI', 'Retail'}
+        if 'reporter IN' not in jql:
+            return {'Retail'}
+        if '"Media Partner - HUB" IN' in jql:
+            return {'YouTube'}
+        if 'product IN' in jql:
+            return {'In-Flight ROI'}
+        return {'Standard'}
+
+    def issue_get(self, path, query, body):
+        ticket = self.ticket(self.path_key(path))
+        if ticket is None:
+            return 404, {"errorMessages": ["Issue does not exist"]}
+        with self.lock:
+            return 200, self.issue_json(ticket)
+
+    def issue_update(self, path, query, body):
+        ticket = self.ticket(self.path_key(path))
+        if ticket is None:
+            return 404, {"errorMessages": ["Issue does not exist"]}
+        fields = body.get('fields', dict())
+        with self.lock:
+            for field, value in fields.items():
+                ticket['fields'][field] = self.user_json(value['name']) if isinstance(value, dict) else value
+            ticket['updates'] += 1
+        return 204, None
+
+    def watchers_get(self, path, query, body):
+        ticket = self.ticket(self.path_key(path))
+        if ticket is None:
+            return 404, {"errorMessages": ["Issue does not exist"]}
+        with self.lock:
+            watchers = [self.user_json(name) for name in ticket['watchers']]
+        return 200, {"self": '{}{}'.format(self.url, path), "isWatching": False, "watchCount": len(watchers),
+                     "watchers": watchers}
+
+    def watcher_add(self, path, query, body):
+        ticket = self.ticket(self.path_key(path))
+        if ticket is None:
+            return 404, {"errorMessages": ["Issue does not exist"]}
+        with self.lock:
+            if body not in ticket['watchers']:
+                ticket['watchers'].append(body)
+        return 204, None
+
+    def transitions_get(self, path, query, body):
+        return 200, {"transitions": [{"id": "21", "name": "Input Verification"}]}
+
+    def transition(self, path, query, body):
+        ticket = self.ticket(self.path_key(path))
+        if ticket is None:
+            return 404, {"errorMessages": ["Issue does not exist"]}
+        with self.lock:
+            ticket['status'] = 'Input Verification'
+        return 204, None
+
+    def session_close(self, path, query, body):
+        return 204, None
+
+    # Looks up a ticket by key or id
+    #
+    def ticket(self, key):
+        with self.lock:
+            if key in self.tickets:
+                return self.tickets[key]
+            return next((ticket for ticket in self.tickets.values() if ticket['id'] == key), None)
+
+    def issue_json(self, ticket):
+        fields = dict(ticket['fields'])
+        fields['status'] = {"name": ticket['status']}
+        return {"id": ticket['id'], "key": ticket['key'], "fields": fields,
+                "self": '{}/rest/api/2/issue/{}'.format(self.url, ticket['id'])}
+
+    @staticmethod
+    def user_json(name):
+        return {"name": name, "key": name, "displayName": name}
+
+    # Counts of the tickets by final status, with the field updates made
+    #
+    def ticket_stats(self):
+        with self.lock:
+            statuses = dict()
+            for ticket in self.tickets.values():
+                statuses[ticket['status']] = statuses.get(ticket['status'], 0) + 1
+            return {"statuses": statuses, "updates": sum(ticket['updates'] for ticket in self.tickets.values())}
+
+
+# Module holds the class => FakeStudyBuilderService - http stub of the Study Builder study endpoint
+# Class responsible for answering /studies/<study number> with the parent company id of the study
+#
+class FakeStudyBuilderService(FakeHTTPService):
+    def __init__(self, parent_ids, latency=0.0, error_rate=0.0, error_status=500, seed=0):
+        FakeHTTPService.__init__(self, latency, error_rate, error_status, seed)
+        self.parent_ids = parent_ids
+
+    def route(self, method, path):
+        if method == 'GET' and re.match(r'/studies/\d+$', path):
+            return 'study', self.study
+        return None, None
+
+    @property
+    def study_url(self):
+        return '{}/studies/'.format(self.url)
+
+    def study(self, path, query, body):
+        study_number = int(path.rpartition('/')[2])
+        if study_number not in self.parent_ids:
+            return 404, {"message": "Study not found"}
+        return 200, {"id": study_number, "parentCompanyId": self.parent_ids[study_number]}
+
+
+# Module holds the class => FakeSMTPService - local smtp sink
+# Class responsible for accepting and counting messages over the smtp commands used by smtplib, injected errors are
+# answered with a temporary (451) failure to the DATA command
+#
+class FakeSMTPService(object):
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.faults = FaultInjector(latency, error_rate, seed)
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.messages = 0
+
+    def start(self):
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                service.faults.request('connection')
+                self.reply('220 fake smtp ready')
+                in_data = False
+                for line in self.rfile:
+                    if in_data:
+                        if line.rstrip(b'\r\n') == b'.':
+                            in_data = False
+                            if service.faults.request('message'):
+                                self.reply('451 injected temporary failure')
+                            else:
+                                with service.lock:
+                                    service.messages += 1
+                                self.reply('250 ok queued')
+                        continue
+                    command = line.strip().split(b' ')[0].upper()
+                    if command == b'EHLO':
+                        self.reply('250-fake smtp\r\n250 8BITMIME')
+                    elif command == b'DATA':
+                        in_data = True
+                        self.reply('354 end data with <CR><LF>.<CR><LF>')
+                    elif command == b'QUIT':
+                        self.reply('221 bye')
+                        return
+                    elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                        self.reply('250 ok')
+                    else:
+                        self.reply('502 command not implemented')
+
+            def reply(self, text):
+                self.wfile.write(text.encode() + b'\r\n')
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='FakeSMTPService', daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def host(self):
+        return '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stats(self):
+        stats = self.faults.stats()
+        stats['delivered'] = self.messages
+        return stats
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# Module holds the class => FakeMySQLConnector - sqlite backed stand-in for mysql.connector
+# Class responsible for handing MySQLManager connections to an sqlite database holding the assignments table, the
+# mysql '%s' parameter style is translated to sqlite. Injected errors are raised as mysql OperationalErrors
+#
+class FakeMySQLConnector(object):
+    def __init__(self, path, latency=0.0, error_rate=0.0, seed=0):
+        self.path = path
+        self.faults = FaultInjector(latency, error_rate, seed)
+
+    # Creates the assignments table from a list of row dicts
+    #
+    def load_table(self, table_name, rows):
+        cnx = sqlite3.connect(self.path)
+        with cnx:
+            columns = list(rows[0])
+            cnx.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+            cnx.execute('CREATE TABLE {} ({})'.format(table_name, ', '.join(columns)))
+            cnx.executemany('INSERT INTO {} VALUES ({})'.format(table_name, ', '.join('?' * len(columns))),
+                            [[row[column] for column in columns] for row in rows])
+        cnx.close()
+
+    def connect(self, **config):
+        if self.faults.request('connection'):
+            raise mysql.connector.errors.OperationalError(msg='Injected connection error', errno=2003)
+        return FakeMySQLConnection(self)
+
+    def stats(self):
+        return self.faults.stats()
+
+
+# Module holds the classes => FakeMySQLConnection, FakeMySQLCursor - the connection and cursor handed to MySQLManager
+#
+class FakeMySQLConnection(object):
+    def __init__(self, connector):
+        self.connector = connector
+        self.database = None
+        self.cnx = sqlite3.connect(connector.path, check_same_thread=False)
+        self.cnx.row_factory = sqlite3.Row
+
+    def cursor(self, dictionary=False, buffered=False):
+        return FakeMySQLCursor(self)
+
+    def ping(self, reconnect=False):
+        if self.cnx is None:
+            raise mysql.connector.errors.InterfaceError(msg='Connection closed', errno=2013)
+
+    def close(self):
+        if self.cnx is not None:
+            self.cnx.close()
+            self.cnx = None
+
+
+class FakeMySQLCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = iter(())
+
+    def execute(self, query, params=()):
+        if self.connection.connector.faults.request('query'):
+            raise mysql.connector.errors.OperationalError(msg='Injected query error', errno=2013)
+        rows = self.connection.cnx.execute(query.replace('%s', '?'), params or ())
+        self.rows = (dict(row) for row in rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def close(self):
+        self.rows = iter(())
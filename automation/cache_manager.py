@@ -0,0 +1,114 @@
+# cache_manager module
+# Module holds the class => StudyCacheManager - manages the persistent study number -> parent company id cache
+# Class responsible for the sqlite cache file kept next to the logs, consulted before any Study Builder call. Entries
+# expire after a time-to-live, studies without a parent company id are kept for a shorter time-to-live, and the oldest
+# entries are evicted once the cache holds more than the maximum number of entries.
+#
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class StudyCacheManager(object):
+    def __init__(self, path, ttl_days=30, negative_ttl_days=1, max_entries=5000):
+        self.path = path
+        self.ttl = float(ttl_days) * 86400
+        self.negative_ttl = float(negative_ttl_days) * 86400
+        self.max_entries = int(max_entries)
+        self.cnx = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+
+    # Opens the cache file, creating the table on first use, and drops expired entries. A cache that cannot be opened
+    # is logged and left disabled, every lookup is then a miss
+    #
+    def open_cache(self):
+        try:
+            self.cnx = sqlite3.connect(self.path, check_same_thread=False)
+            with self.cnx:
+                self.cnx.execute("CREATE TABLE IF NOT EXISTS study_parent ("
+                                 "study_number TEXT PRIMARY KEY, "
+                                 "parent_id TEXT, "
+                                 "fetched_at REAL NOT NULL, "
+                                 "expires_at REAL NOT NULL)")
+                self.cnx.execute("DELETE FROM study_parent WHERE expires_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            self.logger.warning("Study cache %s is unavailable, continuing without it => %s", self.path, e)
+            self.cnx = None
+
+    # Checks whether the cache file is open
+    #
+    def is_open(self):
+        return self.cnx is not None
+
+    # Returns a dict of study number -> parent company id for the cached, unexpired study numbers, a cached None
+    # records a study that returned no parent company id
+    #
+    def get_many(self, study_numbers):
+        study_numbers = list(study_numbers)
+        found = dict()
+        if self.cnx is not None and len(study_numbers) > 0:
+            keys = dict((str(study_number), study_number) for study_number in study_numbers)
+            with self.lock:
+                try:
+                    for start in range(0, len(study_numbers), 500):
+                        chunk = list(keys)[start:start + 500]
+                        rows = self.cnx.execute("SELECT study_number, parent_id FROM study_parent "
+                                                "WHERE expires_at >= ? AND study_number IN ({})"
+                                                .format(','.join('?' * len(chunk))), [time.time()] + chunk)
+                        for study_number, parent_id in rows:
+                            found[keys[study_number]] = json.loads(parent_id)
+                except sqlite3.Error as e:
+                    self.logger.warning("Study cache read failed => %s", e)
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(study_numbers) - len(found)
+        return found
+
+    # Returns (True, parent company id) for a cached study number, else (False, None)
+    #
+    def get(self, study_number):
+        found = self.get_many([study_number])
+        return (True, found[study_number]) if study_number in found else (False, None)
+
+    # Stores a dict of study number -> parent company id, then evicts the oldest entries past the maximum
+    #
+    def put_many(self, parent_ids):
+        if self.cnx is None or len(parent_ids) == 0:
+            return
+        now = time.time()
+        rows = [(str(study_number), json.dumps(parent_id), now,
+                 now + (self.ttl if parent_id is not None else self.negative_ttl))
+                for study_number, parent_id in parent_ids.items()]
+        with self.lock:
+            try:
+                with self.cnx:
+                    self.cnx.executemany("INSERT OR REPLACE INTO study_parent VALUES (?, ?, ?, ?)", rows)
+                    self.cnx.execute("DELETE FROM study_parent WHERE study_number NOT IN "
+                                     "(SELECT study_number FROM study_parent ORDER BY fetched_at DESC LIMIT ?)",
+                                     (self.max_entries,))
+            except sqlite3.Error as e:
+                self.logger.warning("Study cache write failed => %s", e)
+
+    def put(self, study_number, parent_id):
+        self.put_many({study_number: parent_id})
+
+    # Logs the hit and miss counts for the run and returns them, then starts the counts over for the next run
+    #
+    def log_stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits, self.misses = 0, 0
+        self.logger.info("Study cache: %s hits, %s misses", hits, misses)
+        return {"hits": hits, "misses": misses}
+
+    # Closes the cache file
+    #
+    def close_cache(self):
+        if self.cnx is not None:
+            self.cnx.close()
+            self.cnx = None
@@ -1,19 +1,29 @@
 # weekly_emailer module
 # Module holds the class => WeeklyEmailManager - manages the email creation and the smtp interface
 # Class responsible for all email related management
+# Module also holds the class => EmailDigestManager - collects the alerts of a run into one digest email
+# Module also holds the class => EmailDispatchManager - sends the alert emails from a background queue over one
+# persistent smtp connection, so that a slow mail relay does not hold up the ticket processing
 #
-from smtplib import SMTP
+from smtplib import SMTP, SMTPRecipientsRefused, SMTPResponseException
 # from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import os
 import logging
+import queue
+import threading
+import time
+
+from metrics_manager import metrics
 
 
 class EmailManager(object):
-    def __init__(self, ticket, advertiser, subject, to_address, from_address, cc, html_link, data_source):
+    def __init__(self, ticket, advertiser, subject, to_address, from_address, cc, html_link, data_source,
+                 smtp_host='mailhost.valkyrie.net'):
         self.logger = logging.getLogger(__name__)
         self.data_source = data_source
+        self.smtp_host = smtp_host
         self.msg = ""
         self.ticket = ticket
         self.advertiser = advertiser
@@ -56,66 +66,301 @@ class EmailManager(object):
                      "Thanks,\n" + \
                      "Core Services"
 
-    # Create the email in a text format then send via smtp, finally save the email as a StringIO file and return
+    # Create the data fetch alert email in a text format and return it
     #
-    def cm_emailer(self):
-        try:
-            # Text and HTML Email
-            self.msg = MIMEMultipart()
-            self.msg['Subject'] = self.subj
-            self.msg['From'] = self.from_address
-            self.msg['To'] = self.to_address
-            self.msg['Cc'] = self.cc
-
-            # Message Text
-            if self.data_source == '1':
-                part1 = MIMEText(self.text_excel1, 'plain')
-                part2 = MIMEText(self.html, 'html')
-                part3 = MIMEText(self.text2, 'plain')
-
-                self.msg.attach(part1)
-                self.msg.attach(part2)
-                self.msg.attach(part3)
-            else:
-                part1 = MIMEText(self.text_mysql1, 'plain')
-                part3 = MIMEText(self.text2, 'plain')
+    def alert_message(self):
+        # Text and HTML Email
+        self.msg = MIMEMultipart()
+        self.msg['Subject'] = self.subj
+        self.msg['From'] = self.from_address
+        self.msg['To'] = self.to_address
+        self.msg['Cc'] = self.cc
+
+        # Message Text
+        if self.data_source == '1':
+            part1 = MIMEText(self.text_excel1, 'plain')
+            part2 = MIMEText(self.html, 'html')
+            part3 = MIMEText(self.text2, 'plain')
+
+            self.msg.attach(part1)
+            self.msg.attach(part2)
+            self.msg.attach(part3)
+        else:
+            part1 = MIMEText(self.text_mysql1, 'plain')
+            part3 = MIMEText(self.text2, 'plain')
+
+            self.msg.attach(part1)
+            self.msg.attach(part3)
+        return self.msg
+
+    # Create the progress failure alert email in a text format and return it
+    #
+    def progress_alert_message(self):
+        # Simple Text Email
+        self.msg = MIMEMultipart()
+        self.msg['Subject'] = self.subj
+        self.msg['From'] = self.from_address
+        self.msg['To'] = self.to_address
+        self.msg['Cc'] = self.cc
 
-                self.msg.attach(part1)
-                self.msg.attach(part3)
+        part1 = MIMEText(self.text_progress_failure, 'plain')
+        part3 = MIMEText(self.text2, 'plain')
 
-            # Send Email
-            with SMTP('mailhost.valkyrie.net') as smtp:
-                smtp.send_message(self.msg)
+        self.msg.attach(part1)
+        self.msg.attach(part3)
+        return self.msg
 
-        except Exception as e:
-            self.logger.error = ("Email failed for ticket {} => {}".format(self.ticket.key, e))
 
+class EmailDigestManager(object):
+    def __init__(self, subject, to_address, from_address, cc, html_link, data_source):
+        self.logger = logging.getLogger(__name__)
+        self.data_source = data_source
+        self.subj = subject
+        self.to_address = to_address
+        self.from_address = from_address
+        self.cc = cc
+        self.file_name = os.path.basename(html_link)
+        self.alerts = list()
+        self.lock = threading.Lock()
+        self.alert_types = ['data fetch', 'progress']
+        if self.data_source == '1':
+            data_fetch_text = "There appears to be a problem locating the input data for these Jira tickets, you may " \
+                              "wish to check the spreadsheet: '{}', located in the 'CPG_brand_input' directory on " \
+                              "the Operations_mounted zfs1 drive.".format(self.file_name)
         else:
-            self.logger.warning("An alert email for ticket {} has been sent.".format(self.ticket.key))
+            data_fetch_text = "There appears to be a problem locating the input data for these Jira tickets, you may " \
+                              "wish to check the mysql data table: 'assignments', located in the 'cpg_assignments' " \
+                              "schema on the ??? server."
+        self.alert_text = {
+            "data fetch":   data_fetch_text,
+            "progress":     "There was a problem advancing the status of these Jira tickets, ticket field population "
+                            "should be visually checked."
+        }
+
+        self.html = """\
+                <html>
+                    <head></head>
+                    <body>
+                        <p>On MacOs:   <a href="smb://zfs1/Operations_mounted/">//zfs1/Operations_mounted/</a><br>
+
+                           On Windows: <a href="\\zfs1\Operations_mounted\">\\\zfs1\Operations_mounted\</a>
+                        </p>
+                    </body>
+                </html>
+                """
+
+    # Collects an alert of the given type, 'data fetch' or 'progress', for sending with the digest
+    #
+    def add_alert(self, alert_type, ticket, advertiser):
+        with self.lock:
+            self.alerts.append((alert_type, ticket.key, advertiser))
+        self.logger.info("Alert for ticket %s added to the digest", ticket.key)
+
+    # Create the digest text, the alerts grouped by alert type then by advertiser
+    #
+    def digest_text(self):
+        text = "Measurement/CPG Brands,\n\n"
+        for alert_type in self.alert_types:
+            advertisers = dict()
+            for a_type, key, advertiser in self.alerts:
+                if a_type == alert_type:
+                    advertisers.setdefault(advertiser or 'None', list()).append(key)
+            if len(advertisers) == 0:
+                continue
+            text += self.alert_text[alert_type] + "\n\n"
+            for advertiser in sorted(advertisers):
+                text += "Advertiser: {}\n".format(advertiser)
+                for key in sorted(set(advertisers[advertiser])):
+                    text += "    Jira Ticket: {}\n".format(key)
+            text += "\n"
+        return text
+
+    # Ticket keys with an alert in the digest
+    #
+    def alert_keys(self):
+        return sorted(set(key for alert_type, key, advertiser in self.alerts))
+
+    # Create the digest email and return it, None when there are no alerts
+    #
+    def digest_message(self):
+        if len(self.alerts) == 0:
+            return None
+        msg = MIMEMultipart()
+        msg['Subject'] = "{} - {} alert(s)".format(self.subj, len(self.alerts))
+        msg['From'] = self.from_address
+        msg['To'] = self.to_address
+        msg['Cc'] = self.cc
+
+        msg.attach(MIMEText(self.digest_text(), 'plain'))
+        if self.data_source == '1' and any(a_type == 'data fetch' for a_type, key, advertiser in self.alerts):
+            msg.attach(MIMEText("Click on the appropriate link below to navigate to the network server : ", 'plain'))
+            msg.attach(MIMEText(self.html, 'html'))
+        msg.attach(MIMEText("Thanks,\nCore Services", 'plain'))
+        return msg
+
+
+class EmailDispatchManager(object):
+    def __init__(self, smtp_host='mailhost.valkyrie.net', queue_size=100, retries=3, backoff=2, idle_timeout=60):
+        self.logger = logging.getLogger(__name__)
+        self.smtp_host = smtp_host
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.idle_timeout = float(idle_timeout)
+        self.smtp_timeout = 30
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.sender = None
+        self.smtp = None
+        self.lock = threading.Lock()
+        self.stats = dict()
+        self.reset_stats()
+
+    # Hands an email to the sender thread, blocking only while the queue is full. The callback is run by the sender
+    # thread once the email has been sent
+    #
+    def dispatch(self, msg, description, on_sent=None):
+        with self.lock:
+            if self.sender is None or not self.sender.is_alive():
+                self.sender = threading.Thread(target=self.sender_loop, name='EmailSender', daemon=True)
+                self.sender.start()
+        self.queue.put((msg, description, on_sent))
+        with self.lock:
+            self.stats['queued'] += 1
+            self.stats['depth_max'] = max(self.stats['depth_max'], self.queue.qsize())
 
-    # Create the email in a text format then send via smtp, finally save the email as a StringIO file and return
+    # Sends the queued emails one at a time, the smtp connection is kept open between emails and closed once the
+    # queue has been idle for the idle timeout
     #
-    def cm_emailer2(self):
+    def sender_loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            try:
+                if item is None:
+                    self.disconnect()
+                    return
+                self.deliver(*item)
+            except Exception as e:
+                self.logger.error("Email sender error => %s", e)
+            finally:
+                self.queue.task_done()
+
+    # Sends one email, transient failures are retried with exponential backoff on a new connection
+    #
+    def deliver(self, msg, description, on_sent):
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                metrics.count('smtp.send')
+                with metrics.span('email send'):
+                    if self.smtp is None:
+                        self.smtp = SMTP(self.smtp_host, timeout=self.smtp_timeout)
+                    self.smtp.send_message(msg)
+            except Exception as e:
+                if not self.is_transient(e):
+                    self.logger.error("Email failed for %s => %s", description, e)
+                    break
+                self.disconnect()
+                if attempt == self.retries:
+                    self.logger.error("Email failed for %s after %s attempts => %s", description, attempt + 1, e)
+                    break
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning("Email send for %s failed, retrying in %ss => %s", description, delay, e)
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(delay)
+            else:
+                latency = time.time() - start
+                with self.lock:
+                    self.stats['sent'] += 1
+                    self.stats['latency_total'] += latency
+                    self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+                self.logger.warning("An alert email for %s has been sent.", description)
+                if on_sent is not None:
+                    on_sent()
+                return
+        with self.lock:
+            self.stats['failed'] += 1
+
+    # Refused recipients and permanent (5xx) smtp replies are not retried, dropped connections, timeouts and
+    # temporary (4xx) replies are
+    #
+    @staticmethod
+    def is_transient(e):
+        if isinstance(e, SMTPRecipientsRefused):
+            return False
+        if isinstance(e, SMTPResponseException):
+            return 400 <= e.smtp_code < 500
+        return isinstance(e, OSError)
+
+    # Opens the smtp connection ahead of the first alert, the timeout bounds the connection handshake only. Called
+    # before the sender thread is started
+    #
+    def connect(self, timeout):
+        if self.smtp is None:
+            smtp = SMTP(self.smtp_host, timeout=timeout)
+            smtp.sock.settimeout(self.smtp_timeout)
+            self.smtp = smtp
+
+    # Closes the smtp connection, if open
+    #
+    def disconnect(self):
+        if self.smtp is None:
+            return
         try:
-            # Simple Text Email
-            self.msg = MIMEMultipart()
-            self.msg['Subject'] = self.subj
-            self.msg['From'] = self.from_address
-            self.msg['To'] = self.to_address
-            self.msg['Cc'] = self.cc
-
-            part1 = MIMEText(self.text_progress_failure, 'plain')
-            part3 = MIMEText(self.text2, 'plain')
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+        self.smtp = None
 
-            self.msg.attach(part1)
-            self.msg.attach(part3)
+    # Waits until every queued email has been sent or has failed
+    #
+    def flush(self):
+        self.queue.join()
 
-            # Send Email
-            with SMTP('mailhost.valkyrie.net') as smtp:
-                smtp.send_message(self.msg)
+    # Starts the counts over for the next run
+    #
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                "queued":           0,
+                "sent":             0,
+                "failed":           0,
+                "retries":          0,
+                "depth_max":        0,
+                "latency_total":    0.0,
+                "latency_max":      0.0
+            }
 
-        except Exception as e:
-            self.logger.error = ("Email failed for ticket {} => {}".format(self.ticket.key, e))
+    # Logs the queue depth and send latency for the run and returns them, then starts the counts over
+    #
+    def log_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        self.reset_stats()
+        latency_avg = stats['latency_total'] / stats['sent'] if stats['sent'] else 0.0
+        stats['latency_avg'] = latency_avg
+        if stats['queued'] == 0:
+            return stats
+        self.logger.info("Email dispatch: %s queued, %s sent, %s failed, %s retries, %s deepest queue, "
+                         "%.3fs average send, %.3fs longest send", stats['queued'], stats['sent'], stats['failed'],
+                         stats['retries'], stats['depth_max'], latency_avg, stats['latency_max'])
+        return stats
 
+    # Sends any queued emails, then stops the sender thread and closes the smtp connection
+    #
+    def close(self):
+        with self.lock:
+            sender = self.sender
+            self.sender = None
+        if sender is not None and sender.is_alive():
+            self.queue.put(None)
+            sender.join()
         else:
-            self.logger.warning("An alert email for ticket {} has been sent.".format(self.ticket.key))
+            # no sender thread, e.g. a connection opened by the warm up with no alert sent
+            self.disconnect()
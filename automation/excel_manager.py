@@ -1,63 +1,179 @@
 # excel_manager module
 # Module holds the class => ExcelManager - manages the Excel File Interface
-# Class responsible for all the excel file interface, including file name search and data pull
+# Class responsible for all the excel file interface, including the data pull. The 'CPG' sheet is parsed a single time
+# per run into an in-memory index, each ticket lookup is then a dictionary hit. The parsed rows are saved to a compiled
+# snapshot next to the workbook and reused for as long as the workbook fingerprint matches.
 #
-from glob import glob
 from openpyxl import load_workbook
+import hashlib
+import logging
+import os
+import pickle
 
 
 class ExcelManager(object):
-    def __init__(self):
+    def __init__(self, account_file_name):
+        self.sheet_name = 'CPG'
         self.watcher_columns = ['F', 'G', 'H', 'I', 'J']
+        self.column_count = 10  # columns 'A' through 'J'
         self.account_data = dict()
-        self.account_file_name = ""
+        self.account_file_name = account_file_name
+        self.pid_index = dict()
+        self.advertiser_index = dict()
+        self.snapshot_file_name = '{}.snapshot'.format(account_file_name)
+        self.snapshot_version = 1
+        self.loaded_fingerprint = None
+        self.logger = logging.getLogger(__name__)
 
-    # Open workbook and search for row number that corresponds to the ticket pid
+    # Load the row index, from the compiled snapshot when the workbook is unchanged, otherwise from the workbook itself
+    # after which the snapshot is rebuilt
     #
-    def pid_row_search(self, pid, path, media_partner):
-        self.account_file_name = self.get_file_name('{}/*.xlsx'.format(path))
-        wb = load_workbook(filename=self.account_file_name, data_only=True)
-        sheet = wb['CPG']
-        for row in range(1, sheet.max_row+1):
-            if sheet['B{}'.format(row)].value == pid and sheet['D{}'.format(row)].value == media_partner:
-                return row
+    def load_index(self):
+        fingerprint = self.file_fingerprint()
+        self.loaded_fingerprint = dict(fingerprint)
+        rows = self.snapshot_read(fingerprint)
+        if rows is None:
+            rows = self.workbook_read()
+            self.snapshot_write(fingerprint, rows)
+        self.build_index(rows)
+        self.logger.info("Indexed %s rows from the '%s' sheet of %s", len(rows), self.sheet_name,
+                         self.account_file_name)
 
-    # Open workbook and search for row number that corresponds to the ticket advertiser
+    # Check whether the loaded index is out of date, i.e. the workbook has changed or been replaced since loading
     #
-    def advertiser_row_search(self, advertiser, path, media_partner):
-        self.account_file_name = self.get_file_name('{}/*.xlsx'.format(path))
-        wb = load_workbook(filename=self.account_file_name, data_only=True)
-        sheet = wb['CPG']
-        for row in range(1, sheet.max_row+1):
-            if sheet['A{}'.format(row)].value == advertiser and sheet['D{}'.format(row)].value == media_partner:
-                return row
+    def is_stale(self, account_file_name):
+        if account_file_name != self.account_file_name or self.loaded_fingerprint is None:
+            return True
+        fingerprint = self.file_fingerprint()
+        return any(fingerprint[k] != self.loaded_fingerprint[k] for k in ('path', 'size', 'mtime'))
 
-    # With the matched row number as input, read and save account data for email population
+    # Stream the 'CPG' sheet once in read-only mode and return every row as a fixed width tuple
     #
-    def excel_read(self, row):
-        wb = load_workbook(filename=self.account_file_name)
-        sheet = wb['CPG']
+    def workbook_read(self):
+        wb = load_workbook(filename=self.account_file_name, read_only=True, data_only=True)
+        try:
+            sheet = wb[self.sheet_name]
+            return [self.pad_row(row) for row in sheet.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+
+    # Identify the workbook by path, size and modification time
+    #
+    def file_fingerprint(self):
+        stat = os.stat(self.account_file_name)
+        return {
+            "path":     os.path.abspath(self.account_file_name),
+            "size":     stat.st_size,
+            "mtime":    stat.st_mtime_ns,
+            "sha256":   None
+        }
+
+    # Hash the workbook contents, only needed when the path, size and mtime do not match the snapshot
+    #
+    def file_hash(self):
+        digest = hashlib.sha256()
+        with open(self.account_file_name, 'rb') as workbook:
+            for block in iter(lambda: workbook.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
 
+    # Return the snapshot rows when the snapshot matches the workbook fingerprint, else None. A snapshot whose
+    # path, size or mtime differ is still reused if the content hash is unchanged, e.g. after the file is copied
+    #
+    def snapshot_read(self, fingerprint):
+        try:
+            with open(self.snapshot_file_name, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning("Unreadable snapshot %s, rebuilding => %s", self.snapshot_file_name, e)
+            return None
+
+        if snapshot.get('version') != self.snapshot_version or snapshot.get('sheet') != self.sheet_name:
+            return None
+        stored = snapshot.get('fingerprint', dict())
+        if all(stored.get(k) == fingerprint[k] for k in ('path', 'size', 'mtime')):
+            fingerprint['sha256'] = stored.get('sha256')
+            self.logger.info("Using spreadsheet snapshot %s", self.snapshot_file_name)
+            return snapshot['rows']
+
+        fingerprint['sha256'] = self.file_hash()
+        if stored.get('sha256') == fingerprint['sha256']:
+            self.logger.info("Spreadsheet content unchanged, refreshing snapshot %s", self.snapshot_file_name)
+            self.snapshot_write(fingerprint, snapshot['rows'])
+            return snapshot['rows']
+        return None
+
+    # Save the parsed rows with the workbook fingerprint, written to a temporary file first then swapped into place
+    #
+    def snapshot_write(self, fingerprint, rows):
+        if fingerprint['sha256'] is None:
+            fingerprint['sha256'] = self.file_hash()
+        snapshot = {
+            "version":      self.snapshot_version,
+            "sheet":        self.sheet_name,
+            "fingerprint":  fingerprint,
+            "rows":         rows
+        }
+        temp_file_name = '{}.tmp'.format(self.snapshot_file_name)
+        try:
+            with open(temp_file_name, 'wb') as snapshot_file:
+                pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file_name, self.snapshot_file_name)
+        except Exception as e:
+            self.logger.warning("Unable to save snapshot %s => %s", self.snapshot_file_name, e)
+        else:
+            self.logger.info("Spreadsheet snapshot saved to %s", self.snapshot_file_name)
+
+    # Build the two lookup dictionaries from a list of row value tuples
+    #
+    def build_index(self, rows):
+        self.pid_index = dict()
+        self.advertiser_index = dict()
+        for row in rows:
+            self.pid_index.setdefault((row[1], row[3]), row)
+            self.advertiser_index.setdefault((row[0], row[3]), row)
+
+    # Normalize a streamed row to a fixed width, read-only mode drops trailing empty cells
+    #
+    def pad_row(self, row):
+        row = tuple(row[:self.column_count])
+        return row + (None,) * (self.column_count - len(row))
+
+    # Return the indexed row that corresponds to the ticket pid
+    #
+    def pid_row_search(self, pid, media_partner):
+        return self.pid_index.get((pid, media_partner))
+
+    # Return the indexed row that corresponds to the ticket advertiser
+    #
+    def advertiser_row_search(self, advertiser, media_partner):
+        return self.advertiser_index.get((advertiser, media_partner))
+
+    # With the matched row as input, read and save account data for email population
+    #
+    def excel_read(self, row):
         # create a list of watchers
         watchers = list()
         for column in self.watcher_columns:
-            if sheet['{}{}'.format(column, row)].value is not None:
-                watchers.append(sheet['{}{}'.format(column, row)].value)
+            value = row[self.column_position(column)]
+            if value is not None:
+                watchers.append(value)
 
         # create a dictionary of values from excel data
-        self.account_data = {
-            "account_type":         sheet['C{}'.format(row)].value,
-            "media_partner":        sheet['D{}'.format(row)].value,
-            "solutions_mgr":        sheet['F{}'.format(row)].value,
-            "solutions_manager":    sheet['G{}'.format(row)].value,
-            "client_analytics":     sheet['J{}'.format(row)].value,
+        account_data = {
+            "account_type":         row[self.column_position('C')],
+            "media_partner":        row[self.column_position('D')],
+            "solutions_mgr":        row[self.column_position('F')],
+            "solutions_manager":    row[self.column_position('G')],
+            "client_analytics":     row[self.column_position('J')],
             "watchers":             watchers
         }
-        return self.account_data
+        return account_data
 
-    # Search specified folder for what should be the only file, get name and return
+    # Convert a spreadsheet column letter to its position within an indexed row
     #
     @staticmethod
-    def get_file_name(path):
-        for file_name in glob(path):
-            return file_name
+    def column_position(column):
+        return ord(column) - ord('A')
@@ -2,16 +2,20 @@
 # Module holds the class => FieldInputManager - manages the Jira Ticket Field Input Process
 # Class responsible for overall program management
 #
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, timedelta
+import threading
 import time
-import os
 import logging
 from glob import glob
-from jira_manager import JiraManager
-from excel_manager import ExcelManager
-from email_manager import EmailManager
-from api_manager import APICallManager
-from mysql_manager import MySQLManager
+from backend_manager import BackendManager
+from cache_manager import StudyCacheManager
+from watermark_manager import WatermarkManager
+from journal_manager import JournalManager
+from retention_manager import RetentionManager
+from metrics_manager import metrics
+from throttle_manager import ThrottleManager
+from log_manager import log_context, log_stage
 
 today_date = (datetime.now() - timedelta(hours=7)).strftime('%Y-%m-%d')
 
@@ -19,9 +23,20 @@ today_date = (datetime.now() - timedelta(hours=7)).strftime('%Y-%m-%d')
 class FieldInputManager(object):
     def __init__(self, config_params):
         self.data_source = config_params['data_source']
+        self.workers = config_params['workers']
         self.jira_url = config_params['jira_url']
         self.jira_token = config_params['jira_token']
-        self.jira_pars = JiraManager(self.jira_url, self.jira_token)
+        # backends are imported on first use, only those of the configured data source and alert path are loaded
+        self.backends = BackendManager()
+        jira_throttle = ThrottleManager(*config_params['jira_throttle'])
+        self.jira_pars = self.backends.load('tracker', 'jira').JiraManager(self.jira_url, self.jira_token,
+                                                                           config_params['jira_page_size'],
+                                                                           config_params['watcher_concurrency'],
+                                                                           jira_throttle)
+        # the external connections are opened together by warm_up before the first run
+        self.warm_up_timeouts = config_params['warm_up_timeouts']
+        self.warm_up_smtp = config_params['warm_up_smtp']
+        self.warmed_up = False
         self.jql_project = config_params['jql_project']
         self.jql_reporter = config_params['jql_reporter']
         self.jql_product = config_params['jql_product']
@@ -33,16 +48,35 @@ class FieldInputManager(object):
         self.jql_generic_filter1 = config_params['jql_filter1']
         self.jql_generic_filter2 = config_params['jql_filter2']
         self.jql_brand_list = config_params['jql_brand_list']
+        self.jql_search_mode = config_params['jql_search_mode']
         self.study_url = config_params['study_url']
         self.account_url = config_params['account_url']
+        study_backend = self.backends.load('study_lookup', 'study_builder')
+        self.api = study_backend.APICallManager(config_params['api_concurrency'], *config_params['api_resilience'])
+        self.study_unavailable = study_backend.StudyBuilderUnavailable
+        self.batch_size = config_params['jira_page_size']
+        self.parent_ids = dict()
+        self.study_cache = StudyCacheManager(config_params['study_cache_path'], config_params['study_cache_ttl'],
+                                             config_params['study_cache_neg_ttl'], config_params['study_cache_size'])
         self.excel_path = config_params['excel_file']
         self.email_subject = config_params['email_subject']
         self.email_to = config_params['email_to']
         self.email_from = config_params['email_from']
         self.email_cc = config_params['email_cc']
-        self.excel_file_name = glob(('{}/*.xlsx'.format(self.excel_path)))[-1]
+        self.smtp_host = config_params['smtp_host']
+        self.alert_mode = config_params['alert_mode']
+        self.alert_digest = None
+        self.email_dispatch = None      # started with the first alert
+        self.email_dispatch_params = (config_params['email_queue_size'], config_params['email_retries'],
+                                      config_params['email_retry_backoff'], config_params['email_idle_timeout'])
+        self.email_dispatch_lock = threading.Lock()
+        self.excel_file_name = ''       # set from the Excel directory in Excel mode only
         self.db_config = config_params['db_config']
+        self.db_pool = (config_params['db_pool_size'], config_params['db_retries'], config_params['db_retry_backoff'],
+                        config_params['db_pool_timeout'])
         self.db = None
+        self.db_connector = None    # mysql.connector unless replaced, e.g. by the benchmark stand-in
+        self.excel_data = None
         self.db_name = 'cpg_assignments'
         self.table_name = 'assignments'
         self.youtube_media_partner = ['YouTube']
@@ -50,216 +84,550 @@ class FieldInputManager(object):
         self.in_flight_roi_watcher_list = ['isobel.brooks', 'cara.manion']      # additional watchers
         self.youtube_watcher_list = ['andy.fortna']     # additional watchers
         self.ticket_varieties = ['Standard', 'YouTube', 'In-Flight ROI', 'Retail']
-        self.tickets = dict()
+        self.ticket_processors = {
+            'Standard':         self.process_standard,
+            'YouTube':          self.process_youtube,
+            'In-Flight ROI':    self.process_inflight_roi,
+            'Retail':           self.process_retail
+        }
+        self.ticket_counts = dict()
+        self.ticket_outcomes = dict()
+        self.handled_at = dict()
+        self.outcome_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.watermark = WatermarkManager(config_params['watermark_path'], config_params['jql_incremental'],
+                                          config_params['full_sweep_days'], config_params['watermark_overlap'])
+        self.updated_within = None
+        self.pending_keys = []
+        self.search_complete = False
+        self.handled_outcomes = ['populated', 'progressed', 'data fetch failed', 'account type skipped']
+        self.journal = JournalManager(config_params['journal_path'], config_params['app_name'])
+        self.metrics_path = config_params['metrics_path']
+        self.compress_days = config_params['compress_days']
+        self.retention_background = config_params['retention_background']
+        self.retention = None
+        self.app_name = config_params['app_name']
         self.provider_set = set()
         self.null_provider_set = set()
         self.logger = logging.getLogger(__name__)
 
-    # Manages the overall automation
+    # Manages the overall automation, tickets are streamed from the search and processed as they arrive. May be run
+    # repeatedly on the same instance, connections and indexes opened on the first run are reused by later runs. A
+    # resumed run skips the ticket stages already completed by the interrupted run
     #
-    def process_manager(self):
-        try:
-            # Pulls desired tickets via jql
-            self.jira_ticket_search()
-        except Exception as e:
-            self.logger.error("Jira ticket search failed => {}".format(e))
+    def process_manager(self, resume=False, empty_report=True):
+        metrics.reset()
+        self.api.reset_breaker()
+        self.jira_pars.reset_snapshots()
+        self.ticket_counts = dict((variety, 0) for variety in self.ticket_varieties)
+        self.ticket_outcomes = dict()
+        self.handled_at = dict()
+        self.parent_ids = dict()
+        if not self.warmed_up and not self.warm_up():
+            return
+        if not self.open_data_source():
+            return
+        self.journal.open_journal(resume)
+        if self.alert_mode == 'digest':
+            self.alert_digest = self.notifications().EmailDigestManager(self.email_subject, self.email_to,
+                                                                        self.email_from, self.email_cc,
+                                                                        self.excel_file_name, self.data_source)
+
+        # incremental search window from the watermark, None for a full sweep
+        run_start = self.watermark.now()
+        self.watermark.load()
+        self.updated_within = self.watermark.search_window(self.data_source_fingerprint(), run_start)
+        self.pending_keys = self.watermark.pending if self.updated_within is not None else []
+        self.search_complete = False
+        if self.updated_within is not None:
+            self.logger.info("Incremental search, tickets updated in the last %s minutes and %s pending ticket(s)",
+                             self.updated_within, len(self.pending_keys))
         else:
-            # open up connection with data base, if used
-            if self.data_source == '2':
-                self.db = MySQLManager(self.db_config, self.db_name)
-                self.db.establish_connection()
-
-            # iterate through ticket dict for different ticket varieties
-            for k, v in self.tickets.items():
+            self.logger.info("Full ticket search")
 
-                # process 'YouTube' tickets, no transition
-                if k == 'YouTube' and v is not None:
-                    self.process_youtube(k, v)
+        # process each ticket with the handler for its ticket variety, one at a time or across a worker pool
+        if self.workers > 1:
+            self.process_concurrent()
+        else:
+            for variety, ticket in self.ticket_batches():
+                self.ticket_counts[variety] += 1
+                self.process_ticket(variety, ticket)
 
-                # process 'Standard' tickets, full treatment, 2 different account types
-                if k == 'Standard' and v is not None:
-                    self.process_standard(k, v)
+        # print ticket totals to log
+        for variety in self.ticket_varieties:
+            if self.ticket_counts[variety] > 0:
+                self.logger.info("Ticket variety: %s had %s tickets", variety, self.ticket_counts[variety])
+            else:
+                self.logger.info("Ticket variety: %s had no tickets", variety)
+        self.logger.info("\n")
+        metrics.section('outcomes', self.outcome_summary())
+        metrics.section('ticket_counts', dict(self.ticket_counts))
+        metrics.section('study_cache', self.study_cache.log_stats())
+        metrics.section('jira_throttle', self.jira_pars.throttle.log_stats())
+        metrics.section('study_builder', self.api.breaker_stats())
+        self.alert_digest_send()
+        if self.email_dispatch is not None:
+            self.email_dispatch.flush()
+            metrics.section('email_dispatch', self.email_dispatch.log_stats())
+        if self.db is not None:
+            metrics.section('mysql_pool', self.db.stats())
+        self.journal.close_journal(self.search_complete and not self.stop_event.is_set())
+        self.metrics_report(empty_report)
+
+        # move the watermark forward only when every search page was read
+        if self.search_complete:
+            handled = dict((key, self.handled_at[key]) for (variety, key), outcome in self.ticket_outcomes.items()
+                           if outcome in self.handled_outcomes)
+            unfinished_keys = [key for (variety, key), outcome in self.ticket_outcomes.items()
+                               if outcome not in self.handled_outcomes]
+            self.watermark.save(run_start, self.updated_within is None, self.data_source_fingerprint(), handled,
+                                unfinished_keys)
+
+    # Writes the timing metrics of the run as a JSON report beside the log, unless turned off in the config. Without
+    # empty_report a run that handled no tickets writes no report, e.g. an empty service poll
+    #
+    def metrics_report(self, empty_report=True):
+        if self.metrics_path is None or (not empty_report and len(self.ticket_outcomes) == 0):
+            return
+        metrics.section('run', {"search_complete": self.search_complete, "data_source": self.data_source,
+                                "workers": self.workers, "search_mode": self.jql_search_mode,
+                                "incremental": self.updated_within is not None})
+        metrics.write_report('{}{}_{}_metrics.json'.format(self.metrics_path, self.app_name,
+                                                           datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    # Identifies the ticket data source contents for the watermark, a changed spreadsheet or assignments table forces a
+    # full sweep
+    #
+    def data_source_fingerprint(self):
+        if self.data_source == '1' and self.excel_data is not None and self.excel_data.loaded_fingerprint is not None:
+            return [self.excel_data.loaded_fingerprint[k] for k in ('path', 'size', 'mtime')]
+        if self.data_source == '2' and self.db is not None and self.db.assignments_fingerprint is not None:
+            return [self.table_name, self.db.assignments_fingerprint]
+        return None
+
+    # Opens the study cache and the ticket data source, returns False if the data source cannot be opened. The
+    # spreadsheet is indexed again only when the file has changed, the database pool is opened once and the
+    # assignments table is re-read over it for each run
+    #
+    def open_data_source(self):
+        if not self.study_cache.is_open():
+            self.study_cache.open_cache()
 
-                # process 'In-Flight ROI' tickets, no transition
-                if k == 'In-Flight ROI' and v is not None:
-                    self.process_inflight_roi(k, v)
+        # parse the spreadsheet once into an in-memory index, if used
+        if self.data_source == '1':
+            try:
+                self.excel_file_name = glob('{}/*.xlsx'.format(self.excel_path))[-1]
+                if self.excel_data is None or self.excel_data.is_stale(self.excel_file_name):
+                    with metrics.span('data source load'):
+                        excel_data = self.backends.load('data_source', '1').ExcelManager(self.excel_file_name)
+                        excel_data.load_index()
+                    self.excel_data = excel_data
+            except Exception as e:
+                self.logger.error("Excel file load error for %s, there may be a problem with the file => %s",
+                                  self.excel_file_name, e)
+                # with no earlier index to fall back on there is nothing to look the tickets up in
+                if self.excel_data is None:
+                    return False
+
+        # open up connection with data base, if used
+        if self.data_source == '2':
+            if self.db is None:
+                try:
+                    self.db = self.open_database()
+                except Exception as e:
+                    self.logger.error("MySQL connection failed, no tickets will be processed => %s", e)
+                    return False
+            try:
+                with metrics.span('data source load'):
+                    self.db.load_assignments(self.table_name)
+            except Exception as e:
+                self.logger.error("MySQL assignments load error for table %s => %s", self.table_name, e)
+        return True
 
-                # process 'Retail' tickets, transition only
-                if k == 'Retail' and v is not None:
-                    self.process_retail(k, v)
+    # Opens the database pool with its first connection, raises when no connection can be made within the timeout
+    #
+    def open_database(self, timeout=None):
+        db = self.backends.load('data_source', '2').MySQLManager(self.db_config, self.db_name, *self.db_pool,
+                                                                 connector=self.db_connector)
+        db.establish_connection(timeout)
+        return db
+
+    # Opens the external connections of the configured path together, before any ticket is touched -> the Jira
+    # session, the MySQL pool, the Study Builder http pool and, when configured, the smtp connection. Each target has
+    # its own timeout, so that startup costs the slowest handshake rather than the sum of them. Every failure is logged
+    # up front, returns False when Jira or the database cannot be reached. A Study Builder or smtp failure is a warning
+    # only, those connections are opened again on first use
+    #
+    def warm_up(self):
+        targets = [('jira', lambda timeout: self.jira_pars.connect(timeout), True),
+                   ('study_builder', lambda timeout: self.api.connect(self.study_url, timeout), False)]
+        if self.data_source == '2' and self.db is None:
+            targets.append(('mysql', lambda timeout: self.open_database(timeout), True))
+        if self.warm_up_smtp:
+            targets.append(('smtp', lambda timeout: self.dispatcher().connect(timeout), False))
+
+        ready = True
+        opened = 0
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='WarmUp')
+        futures = [executor.submit(self.warm_up_target, name, connect, self.warm_up_timeouts[name])
+                   for name, connect, required in targets]
+        for (name, connect, required), future in zip(targets, futures):
+            timeout = self.warm_up_timeouts[name]
+            try:
+                result = future.result(timeout=max(0.0, timeout - (time.perf_counter() - start)))
+            except FutureTimeout:
+                error = 'no connection within {}s'.format(timeout)
+                if name == 'mysql':
+                    future.add_done_callback(self.warm_up_discard)
+            except Exception as e:
+                error = e
+            else:
+                if name == 'mysql':
+                    self.db = result
+                opened += 1
+                continue
+            if required:
+                self.logger.error("Warm up: %s connection failed, no tickets will be processed => %s", name, error)
+                ready = False
+            else:
+                self.logger.warning("Warm up: %s connection failed, it will be retried on first use => %s", name, error)
+        # a connection attempt still running past its timeout is left to finish in the background, a late database
+        # pool is closed as soon as it is opened
+        executor.shutdown(wait=False)
+        metrics.record_startup('warm up', time.perf_counter() - start)
+        self.logger.info("Warm up: %s of %s connection(s) opened in %.3fs", opened, len(targets),
+                         time.perf_counter() - start)
+        self.warmed_up = ready
+        return ready
+
+    # Closes a database pool that was opened after its warm up timeout, it is never used and the next run opens its own
+    #
+    @staticmethod
+    def warm_up_discard(future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().close_connection()
 
-            self.logger.info("\n")
+    # Opens a single warm up connection, timed as a startup cost
+    #
+    @staticmethod
+    def warm_up_target(name, connect, timeout):
+        with metrics.startup_span('connect {}'.format(name)):
+            return connect(timeout)
 
-            # close connection to data base, if used
-            if self.data_source == '2':
-                self.db.close_connection()
+    # Closes everything held open between runs, the database pool, http session, study cache and Jira session
+    #
+    def shutdown(self):
+        if self.db is not None:
+            self.db.close_connection()
+            self.db = None
+        self.api.close_session()
+        self.study_cache.close_cache()
+        if self.retention is not None:
+            self.retention.wait()
+        if self.email_dispatch is not None:
+            self.email_dispatch.close()
+            self.email_dispatch = None
+        try:
+            self.jira_pars.kill_session()
+        except Exception as e:
+            self.logger.warning("Jira session close failed => %s", e)
+        self.warmed_up = False
 
-    # Manages the jira ticket search
+    # Hands tickets to a bounded pool of worker threads as they stream in from the search, at most two tickets per
+    # worker are queued ahead so a large search is never held in memory all at once
     #
-    def jira_ticket_search(self):
-        # pull desired tickets via jql, for two different verticals 'Retail/CPG Retail' or 'CPG Brands'
+    def process_concurrent(self):
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='TicketWorker') as executor:
+            for variety, ticket in self.ticket_batches():
+                self.ticket_counts[variety] += 1
+                slots.acquire()
+                future = executor.submit(self.process_ticket, variety, ticket)
+                future.add_done_callback(lambda f: slots.release())
+
+    # Runs the handler for a single ticket and records its outcome, an error is contained to its own ticket. The
+    # thread is named after the ticket for the duration so that each log line is tagged with the ticket key
+    #
+    def process_ticket(self, variety, ticket):
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = ticket.key
+        log_context.bind(ticket.key, variety)
+        try:
+            with metrics.span('ticket'):
+                outcome = self.ticket_processors[variety](variety, ticket)
+        except self.study_unavailable as e:
+            # Study Builder is failing, the ticket is left untouched and without an alert for the next run
+            self.logger.warning("Ticket %s deferred to the next run => %s", ticket.key, e)
+            outcome = 'deferred'
+        except Exception as e:
+            self.logger.error("Processing failed for ticket %s => %s", ticket.key, e)
+            outcome = 'error'
+        finally:
+            thread.name = thread_name
+            log_context.clear()
+        # the ticket's writes have finished, any later update to it is someone else's
+        handled_at = self.watermark.now()
+        with self.outcome_lock:
+            self.ticket_outcomes[(variety, ticket.key)] = outcome
+            self.handled_at[ticket.key] = handled_at
+
+    # Prints the outcome of every ticket to log, ordered by ticket variety then ticket number, followed by totals,
+    # and returns the totals
+    #
+    def outcome_summary(self):
+        self.logger.info("Run summary:")
+        totals = dict()
         for variety in self.ticket_varieties:
-            if variety != 'Retail':
-                self.tickets[variety] = self.jira_pars.find_tickets(variety, self.jql_project, self.jql_reporter,
-                                                                    self.jql_type, self.jql_vertical, self.jql_status,
-                                                                    self.jql_product, self.jql_yt_media_partner)
-            else:
-                self.tickets[variety] = self.jira_pars.find_tickets(variety, self.jql_project, self.jql_reporter,
-                                                                    self.jql_type, self.jql_vertical2, self.jql_status,
-                                                                    self.jql_product, self.jql_yt_media_partner)
-        # print list of found tickets to log
-        for k, v in self.tickets.items():
-            if v is not None:
-                self.logger.info("Ticket variety: {} has {} tickets".format(k, len(v)))
-                for ticket in v:
-                    if v is not None:
-                        self.logger.info("{} {}".format(ticket.key, ticket.fields.reporter.displayName))
-            else:
-                self.logger.info("Ticket variety: {} has no tickets".format(k))
-            self.logger.info("\n")
+            keys = sorted((key for v, key in self.ticket_outcomes if v == variety), key=self.ticket_sort_key)
+            for key in keys:
+                outcome = self.ticket_outcomes[(variety, key)]
+                totals[outcome] = totals.get(outcome, 0) + 1
+                self.logger.info("%s%s%s", variety.ljust(16), key.ljust(12), outcome)
+        for outcome in sorted(totals):
+            self.logger.info("%s ticket(s): %s", totals[outcome], outcome)
+        self.logger.info("\n")
+        return totals
+
+    # Sort tickets by project then by number, e.g. 'DC-98' before 'DC-100'
+    #
+    @staticmethod
+    def ticket_sort_key(key):
+        project, _, number = key.rpartition('-')
+        return (project, int(number)) if number.isdigit() else (key, 0)
+
+    # Groups the ticket stream into batches of one search page, the parent company ids for the batch are fetched
+    # from Study Builder together before any ticket of the batch is handed out for processing
+    #
+    def ticket_batches(self):
+        batch = list()
+        for variety, ticket in self.ticket_stream():
+            batch.append((variety, ticket))
+            if len(batch) >= self.batch_size:
+                self.parent_id_prefetch(batch)
+                for item in batch:
+                    yield item
+                batch = list()
+        self.parent_id_prefetch(batch)
+        for item in batch:
+            yield item
+
+    # Times the parent company id lookup for a batch as one sample of the 'study id prefetch' stage
+    #
+    def parent_id_prefetch(self, batch):
+        with metrics.span('study id prefetch'):
+            self.parent_id_batch(batch)
 
-    # Process tickets with 'YouTube' as media partner
+    # Collects the study numbers of the batch tickets without a pid and resolves them in one concurrent batch
+    #
+    def parent_id_batch(self, batch):
+        study_numbers = set()
+        for variety, ticket in batch:
+            if variety == 'Retail' or self.jira_pars.pid_info_pull(ticket) is not None:
+                continue
+            try:
+                study_numbers.add(self.jira_pars.ticket_information_pull(ticket)[1])
+            except Exception as e:
+                self.logger.warning("No study number for ticket %s => %s", ticket.key, e)
+        study_numbers.difference_update(self.parent_ids)
+        self.parent_ids.update(self.study_cache.get_many(study_numbers))
+        study_numbers.difference_update(self.parent_ids)
+        if len(study_numbers) > 0:
+            resolved = self.api.parent_id_batch(self.study_url, study_numbers)
+            self.study_cache.put_many(resolved)
+            self.parent_ids.update(resolved)
+            self.logger.info("Resolved %s of %s study numbers from Study Builder", len(resolved), len(study_numbers))
+
+    # Wraps the jira ticket search so that a failed search page ends the stream with a logged error, the stream also
+    # ends early once a stop has been requested, the tickets already handed out are still completed
+    #
+    def ticket_stream(self):
+        try:
+            for variety, ticket in self.jira_ticket_search():
+                if self.stop_event.is_set():
+                    self.logger.info("Stop requested, no further tickets will be started")
+                    return
+                if self.watermark.is_handled(ticket.key, getattr(ticket.fields, 'updated', None)):
+                    self.logger.info("%s: %s was handled by the last run and not updated since", variety, ticket.key)
+                    continue
+                yield variety, ticket
+        except Exception as e:
+            self.logger.error("Jira ticket search failed => %s", e)
+        else:
+            self.search_complete = True
+
+    # Manages the jira ticket search, yields (ticket variety, ticket) pairs as each search page arrives
+    #
+    def jira_ticket_search(self):
+        # pull desired tickets via one union jql, classified locally into the ticket varieties
+        if self.jql_search_mode == 'combined':
+            tickets = self.jira_pars.search_tickets_combined(self.jql_project, self.jql_reporter, self.jql_type,
+                                                             self.jql_vertical, self.jql_vertical2,
+                                                             self.jql_status, self.jql_product,
+                                                             self.jql_yt_media_partner, self.updated_within,
+                                                             self.pending_keys)
+            for variety, ticket in tickets:
+                self.logger.info("%s: %s %s", variety, ticket.key, ticket.fields.reporter.displayName)
+                yield variety, ticket
+        else:
+            # pull desired tickets via jql, for two different verticals 'Retail/CPG Retail' or 'CPG Brands'
+            for variety in self.ticket_varieties:
+                self.logger.info("'%s' ticket type", variety)
+                vertical = self.jql_vertical if variety != 'Retail' else self.jql_vertical2
+                tickets = self.jira_pars.search_tickets(variety, self.jql_project, self.jql_reporter, self.jql_type,
+                                                        vertical, self.jql_status, self.jql_product,
+                                                        self.jql_yt_media_partner, self.updated_within,
+                                                        self.pending_keys)
+                for ticket in tickets:
+                    self.logger.info("%s: %s %s", variety, ticket.key, ticket.fields.reporter.displayName)
+                    yield variety, ticket
+
+    # Process a ticket with 'YouTube' as media partner
     #
-    def process_youtube(self, k, v):
-        self.logger.info("'{}' ticket type".format(k))
-        self.logger.info("{} ticket(s) were found that match the criteria.\n".format(len(v)))
-        time.sleep(2)
-        for ticket in v:
-            advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, v)
+    def process_youtube(self, k, ticket):
+        advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, ticket)
 
+        if data_dict is not None:
             # for 'YouTube' add specified watchers to ticket
             for k1, v1 in data_dict.items():
                 if k1 == 'watchers':
                     v1.extend(self.youtube_watcher_list)
+            # populates the jira ticket with field information, does not progress ticket
+            outcome = self.populate_not_progress(ticket, data_dict, advertiser)
 
-            if data_dict is not None:
-                # populates the jira ticket with field information, does not progress ticket
-                self.populate_not_progress(ticket, data_dict, advertiser)
+        else:
+            self.logger.error("Data fetch failed for ticket: %s", ticket.key)
+            self.emailer(ticket, advertiser)
+            outcome = 'data fetch failed'
+        self.logger.info("\n")
+        return outcome
 
-            else:
-                self.logger.error("Data fetch failed for ticket: {}".format(ticket.key))
-                self.emailer(ticket, advertiser)
-            self.logger.info("\n")
-
-    # Process 'CPG Brands' tickets, both 'Enterprise' and 'Core Brands' accounts
-    #
-    def process_standard(self, k, v):
-        self.logger.info("'{}' ticket type".format(k))
-        self.logger.info("{} ticket(s) were found that match the criteria.\n".format(len(v)))
-        time.sleep(2)
-        for ticket in v:
-            advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, v)
-
-            if data_dict is not None:
-                # check account type, first 'Enterprise' accounts
-                if data_dict['account_type'] == 'Enterprise':
-                    self.logger.info("Account Type: {}".format(data_dict.get('account_type')))
-                    # populates the jira ticket with field information
-                    self.populate_and_progress(ticket, data_dict, advertiser)
-
-                # next 'Core Brands' accounts
-                elif data_dict['account_type'] == 'Core Brands':
-                    self.logger.info("Account Type: {}".format(data_dict.get('account_type')))
-                    # populates the jira ticket with field information
-                    self.populate_and_progress(ticket, data_dict, advertiser)
+    # Process a 'CPG Brands' ticket, both 'Enterprise' and 'Core Brands' accounts
+    #
+    def process_standard(self, k, ticket):
+        advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, ticket)
+        outcome = 'account type skipped'
+
+        if data_dict is not None:
+            # check account type, first 'Enterprise' accounts
+            if data_dict['account_type'] == 'Enterprise':
+                self.logger.info("Account Type: %s", data_dict.get('account_type'))
+                # populates the jira ticket with field information
+                outcome = self.populate_and_progress(ticket, data_dict, advertiser)
 
-            else:
-                self.logger.error("Data fetch failed for ticket: {}".format(ticket.key))
-                self.emailer(ticket, advertiser)
-            self.logger.info("\n")
-
-    # Process 'In-Flight ROI' tickets
-    #
-    def process_inflight_roi(self, k, v):
-        self.logger.info("'{}' ticket type".format(k))
-        self.logger.info("{} ticket(s) were found that match the criteria.\n".format(len(v)))
-        time.sleep(2)
-        for ticket in v:
-            advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, v)
-
-            if data_dict is not None:
-                # add additional watchers for this ticket type
-                for k1, v1 in data_dict.items():
-                    if k1 == 'watchers':
-                        v1.extend(self.in_flight_roi_watcher_list)
+            # next 'Core Brands' accounts
+            elif data_dict['account_type'] == 'Core Brands':
+                self.logger.info("Account Type: %s", data_dict.get('account_type'))
                 # populates the jira ticket with field information
-                self.populate_not_progress(ticket, data_dict, advertiser)
-            else:
-                self.logger.error("Data fetch failed for ticket: {}".format(ticket.key))
-                self.emailer(ticket, advertiser)
-            self.logger.info("\n")
+                outcome = self.populate_and_progress(ticket, data_dict, advertiser)
+
+        else:
+            self.logger.error("Data fetch failed for ticket: %s", ticket.key)
+            self.emailer(ticket, advertiser)
+            outcome = 'data fetch failed'
+        self.logger.info("\n")
+        return outcome
 
-    # Process 'Retail' tickets
+    # Process an 'In-Flight ROI' ticket
     #
-    def process_retail(self, k, v):
-        self.logger.info("'{}' ticket type".format(k))
-        self.logger.info("{} ticket(s) were found that match the criteria.\n".format(len(v)))
-        time.sleep(2)
-        # iterate through list of tickets
-        for ticket in v:
-            # collect ticket level info
-            advertiser, study_number = self.jira_pars.ticket_information_pull(ticket)
-            # progress the status of ticket
-            try:
-                self.jira_pars.progress_ticket(ticket.key)
-            except Exception as e:
-                self.logger.error("Jira ticket status progress error for ticket {}, "
-                                  "ticket field population should be visually checked => {}"
-                                  .format(ticket.key, e))
-                # code to send warning email
-                self.emailer2(ticket, advertiser)
-            else:
-                self.logger.info("The ticket {} has been progressed to 'Input Verification' "
-                                 "status".format(ticket.key))
+    def process_inflight_roi(self, k, ticket):
+        advertiser, data_dict, provider_set, null_provider_set = self.jira_ticket_pull(k, ticket)
+
+        if data_dict is not None:
+            # add additional watchers for this ticket type
+            for k1, v1 in data_dict.items():
+                if k1 == 'watchers':
+                    v1.extend(self.in_flight_roi_watcher_list)
+            # populates the jira ticket with field information
+            outcome = self.populate_not_progress(ticket, data_dict, advertiser)
+        else:
+            self.logger.error("Data fetch failed for ticket: %s", ticket.key)
+            self.emailer(ticket, advertiser)
+            outcome = 'data fetch failed'
+        self.logger.info("\n")
+        return outcome
+
+    # Process a 'Retail' ticket
+    #
+    def process_retail(self, k, ticket):
+        # collect ticket level info
+        advertiser, study_number = self.jira_pars.ticket_information_pull(ticket)
+        # progress the status of ticket
+        return self.progress(ticket, advertiser)
 
     # Jira ticket population with ticket progression
     #
     def populate_and_progress(self, ticket, data_dict, advertiser):
-        try:
-            self.jira_ticket_populate(ticket, data_dict, advertiser, data_dict['account_type'])
-            self.logger.info("List of names and ticket fields: {}".format(data_dict))
-        except Exception as e:
-            self.logger.error("Jira ticket field populate error for ticket {}, "
-                              "ticket field population should be visually checked => {}"
-                              .format(ticket.key, e))
-        else:
-            # if field population success, progress the status of ticket
-            try:
-                self.jira_pars.progress_ticket(ticket.key)
-            except Exception as e:
-                self.logger.error("Jira ticket status progress error for ticket {}, "
-                                  "ticket field population should be visually checked => {}"
-                                  .format(ticket.key, e))
-                # send warning email
-                self.emailer2(ticket, advertiser)
-            else:
-                self.logger.info("The ticket {} has been progressed to 'Input Verification'"
-                                 " status".format(ticket.key))
+        if not self.populate(ticket, data_dict, advertiser, data_dict['account_type']):
+            return 'populate failed'
+        # if field population success, progress the status of ticket
+        return self.progress(ticket, advertiser)
 
     # Jira ticket population without ticket progression
     #
     def populate_not_progress(self, ticket, data_dict, advertiser):
+        if not self.populate(ticket, data_dict, advertiser, None):
+            return 'populate failed'
+        self.logger.info("The ticket %s has not been progressed.", ticket.key)
+        return 'populated'
+
+    # Populates the jira ticket fields, returns False on failure. Skipped when already done by a resumed run
+    #
+    @log_stage('populate')
+    def populate(self, ticket, data_dict, advertiser, account_type):
+        if self.journal.completed(ticket.key, 'populated'):
+            self.logger.info("The ticket %s was populated by the interrupted run", ticket.key)
+            return True
         try:
-            self.jira_ticket_populate(ticket, data_dict, advertiser, None)
-            self.logger.info("List of names and ticket fields: {}".format(data_dict))
+            self.jira_ticket_populate(ticket, data_dict, advertiser, account_type)
+            self.logger.info("List of names and ticket fields: %s", data_dict)
         except Exception as e:
-            self.logger.error("Jira ticket field populate error for ticket {}, "
-                              "ticket field population should be visually checked => {}"
-                              .format(ticket.key, e))
+            self.logger.error("Jira ticket field populate error for ticket %s, "
+                              "ticket field population should be visually checked => %s", ticket.key, e)
+            return False
+        self.journal.record(ticket.key, 'populated')
+        return True
+
+    # Progresses the status of the ticket to 'Input Verification', a failure is alerted by email. Skipped when already
+    # done by a resumed run
+    #
+    @log_stage('progress')
+    def progress(self, ticket, advertiser):
+        if self.journal.completed(ticket.key, 'progressed'):
+            self.logger.info("The ticket %s was progressed by the interrupted run", ticket.key)
+            return 'progressed'
+        try:
+            self.jira_pars.progress_ticket(ticket.key)
+        except Exception as e:
+            self.logger.error("Jira ticket status progress error for ticket %s, "
+                              "ticket field population should be visually checked => %s", ticket.key, e)
+            # send warning email
+            self.emailer2(ticket, advertiser)
+            return 'progress failed'
         else:
-            self.logger.info("The ticket {} has not been progressed.".format(ticket.key))
+            self.journal.record(ticket.key, 'progressed')
+            self.logger.info("The ticket %s has been progressed to 'Input Verification' status", ticket.key)
+            return 'progressed'
 
-    # Retrieve information from Jira ticket
+    # Retrieve information from Jira ticket, the ticket data resolved by an interrupted run is taken from the journal
     #
-    def jira_ticket_pull(self, k, v):
-        for ticket in v:
+    @log_stage('resolve')
+    def jira_ticket_pull(self, k, ticket):
+        if self.journal.completed(ticket.key, 'resolved'):
+            resolved = self.journal.stage_data(ticket.key, 'resolved')
+            self.logger.info("The ticket %s data was resolved by the interrupted run", ticket.key)
+            return resolved['advertiser'], resolved['data_dict'], set(), set()
+        with metrics.span('ticket information pull'):
             advertiser, study_number = self.jira_pars.ticket_information_pull(ticket)
             pid = self.jira_pars.pid_info_pull(ticket)
             media_partner = self.jira_pars.media_partner_pull(ticket, advertiser)
-            self.logger.info("'{}': parent id".format(pid))
+        self.logger.info("'%s': parent id", pid)
+        with metrics.span('data lookup'):
             data_dict, provider_set, null_provider_set = self.source_data(pid, ticket, advertiser,
                                                                           study_number, k, media_partner)
-            return advertiser, data_dict, provider_set, null_provider_set
+        self.journal.record(ticket.key, 'resolved', {"advertiser": advertiser, "data_dict": data_dict})
+        return advertiser, data_dict, provider_set, null_provider_set
 
     # Sources the ticket input data from either spreadsheet or database
     #
@@ -269,68 +637,66 @@ class FieldInputManager(object):
         data_dict = dict()
 
         if pid is not None:
-            self.logger.info('From Jira Ticket, {}{}{}'.format(ticket.key.ljust(12),
-                                                               advertiser.ljust(30, '.'),
-                                                               str(pid).rjust(10, '.')))
+            self.logger.info('From Jira Ticket, %s%s%s', ticket.key.ljust(12), advertiser.ljust(30, '.'),
+                             str(pid).rjust(10, '.'))
             provider_set.add(advertiser)
 
             # check for data source 1 is excel file, 2 is mysql
             if self.data_source == '1':
                 data_dict = self.excel_data_fetch(int(pid), ticket, ticket_type, media_partner)
             else:
-                data_dict = self.mysql_data_fetch(advertiser, ticket, ticket_type, media_partner)
+                data_dict = self.mysql_data_fetch(int(pid), ticket, ticket_type, media_partner)
 
         elif pid is None:
             parent_id = self.api_manager(study_number)
-            self.logger.info('From Study Builder, {}{}{}'.format(ticket.key.ljust(12),
-                                                                 advertiser.ljust(30, '.'),
-                                                                 str(parent_id).rjust(10, '.')))
+            self.logger.info('From Study Builder, %s%s%s', ticket.key.ljust(12), advertiser.ljust(30, '.'),
+                             str(parent_id).rjust(10, '.'))
             provider_set.add(advertiser)
 
             # check for data source 1 is excel file, 2 is mysql
             if self.data_source == '1':
                 data_dict = self.excel_data_fetch(parent_id, ticket, ticket_type, media_partner)
             else:
-                data_dict = self.mysql_data_fetch(advertiser, ticket, ticket_type, media_partner)
+                data_dict = self.mysql_data_fetch(parent_id, ticket, ticket_type, media_partner)
         else:
-            self.logger.info('{}{}{}'.format(ticket.key.ljust(12), advertiser.ljust(30, '.'),
-                                             "None".rjust(10, '.')))
+            self.logger.info('%s%s%s', ticket.key.ljust(12), advertiser.ljust(30, '.'), "None".rjust(10, '.'))
             null_provider_set.add(advertiser)
         return data_dict, provider_set, null_provider_set
 
-    # Manages the api class instance creation and function calls
+    # Manages the api function calls, a study number already resolved in a batch is answered from the batch results
     #
     def api_manager(self, id_num):
-        # create api search object instance
-        api_manager = APICallManager()
+        if id_num in self.parent_ids:
+            return self.parent_ids[id_num]
+        cached, parent_company_id = self.study_cache.get(id_num)
+        if cached:
+            return parent_company_id
 
         # api call to find study data
-        study_call_results = api_manager.api_call(self.study_url, id_num)
+        status, study_call_results = self.api.api_call(self.study_url, id_num)
 
-        # confirm api call returned results, search to find required data
-        if study_call_results is not None:
-            parent_company_id = api_manager.parent_id_fetch(study_call_results)
-            return parent_company_id
-        else:
-            return None
+        # search the results to find required data, only a 200 answer or a 404 for an unknown study is cached
+        parent_company_id = self.api.parent_id_fetch(study_call_results)
+        if status in self.api.answer_status:
+            self.study_cache.put(id_num, parent_company_id)
+        return parent_company_id
 
     # Manages the excel data pull
     #
     def excel_data_fetch(self, advertiser, ticket, ticket_type, media_partner):
-        excel_data = ExcelManager()
         try:
             # check for ticket type from key value, if standard - search excel via pid, else search via advertiser name
             if ticket_type == 'Standard' or ticket_type == 'In-Flight ROI' or ticket_type == 'YouTube':
-                row_identifier = excel_data.pid_row_search(int(advertiser), self.excel_path, media_partner)
+                row_identifier = self.excel_data.pid_row_search(int(advertiser), media_partner)
             else:
-                row_identifier = excel_data.advertiser_row_search(advertiser, self.excel_path, media_partner)
+                row_identifier = self.excel_data.advertiser_row_search(advertiser, media_partner)
         except Exception as e:
-            self.logger.error("Excel file row location error for ticket {}, there may be a problem with the file => {}"
-                              .format(ticket.key, e))
+            self.logger.error("Excel file row location error for ticket %s, there may be a problem with the file => %s",
+                              ticket.key, e)
             return None
         else:
             if row_identifier is not None:
-                excel_data_dict = excel_data.excel_read(row_identifier)
+                excel_data_dict = self.excel_data.excel_read(row_identifier)
                 return excel_data_dict
             else:
                 return None
@@ -342,14 +708,14 @@ class FieldInputManager(object):
                         'solutions_ops_owner2']
         watchers = list()
         try:
-            # check for ticket type via sql search on '' column
+            # check for ticket type, search the preloaded assignments on the 'account' column via pid or advertiser name
             if ticket_type == 'Standard' or ticket_type == 'In-Flight ROI' or ticket_type == 'YouTube':
-                mysql_dict = self.db.get_data(self.table_name, int(advertiser), media_partner)
+                mysql_dict = self.db.assignment_lookup(int(advertiser), media_partner)
             else:
-                mysql_dict = self.db.get_data(self.table_name, advertiser, media_partner)
+                mysql_dict = self.db.assignment_lookup(advertiser, media_partner)
         except Exception as e:
-            self.logger.error("MySQL row location error for ticket {}, there may be a problem with the data set => {}"
-                              .format(ticket.key, e))
+            self.logger.error("MySQL row location error for ticket %s, there may be a problem with the data set => %s",
+                              ticket.key, e)
             return None
         else:
             # create a list out of watchers, remove Nones, and add to dictionary
@@ -365,50 +731,90 @@ class FieldInputManager(object):
     # Manages the jira ticket field population
     #
     def jira_ticket_populate(self, ticket, account_dict, advertiser, account_type):
+        # collect the ticket changes, written as one field update followed by the watcher adds
+        update = self.jira_pars.new_update(ticket)
         if account_type is not None and account_type == 'Core Brands':
-            self.jira_pars.add_watcher(ticket, account_dict.get('solutions_mgr'))
-            self.jira_pars.update_reporter(ticket, account_dict.get('solutions_mgr'))
+            update.add_watcher(account_dict.get('solutions_mgr'))
+            update.set_reporter(account_dict.get('solutions_mgr'))
         else:
             if account_dict.get('solutions_mgr') is not None:
-                self.jira_pars.update_field(ticket, 'lead analyst', account_dict.get('client_analytics'))
+                update.set_lead_analyst(account_dict.get('client_analytics'))
                 for watcher in account_dict.get('watchers'):
-                    self.jira_pars.add_watcher(ticket, watcher)
-                self.jira_pars.update_reporter(ticket, account_dict.get('solutions_manager'))
-                pass
+                    update.add_watcher(watcher)
+                update.set_reporter(account_dict.get('solutions_manager'))
             else:
                 self.logger.error("There was no reporter listed")
                 self.emailer(ticket, advertiser)
+                return
+        self.jira_pars.commit_update(update)
 
-    # Creates the Email Manager instance, launches the emailer module
+    # Creates the Email Manager instance, launches the emailer module, in digest mode the alert is collected for the
+    # run digest instead. An alert already sent by an interrupted run is not sent again
     #
+    @log_stage('alert')
     def emailer(self, ticket, advertiser):
-        cm_email = EmailManager(ticket, advertiser, self.email_subject, self.email_to, self.email_from, self.email_cc,
-                                self.excel_file_name, self.data_source)
-        cm_email.cm_emailer()
-
-    # Creates the Email Manager instance, launches the emailer module
+        if self.journal.completed(ticket.key, 'emailed'):
+            self.logger.info("The alert email for ticket %s was sent by the interrupted run", ticket.key)
+            return
+        if self.alert_digest is not None:
+            self.alert_digest.add_alert('data fetch', ticket, advertiser)
+            return
+        cm_email = self.notifications().EmailManager(ticket, advertiser, self.email_subject, self.email_to,
+                                                     self.email_from, self.email_cc, self.excel_file_name,
+                                                     self.data_source, self.smtp_host)
+        self.dispatcher().dispatch(cm_email.alert_message(), 'ticket {}'.format(ticket.key),
+                                   lambda: self.journal.record(ticket.key, 'emailed'))
+
+    # Creates the Email Manager instance, launches the emailer module, in digest mode the alert is collected for the
+    # run digest instead. The alert follows a failed progress attempt made by this run, so it is sent even when the
+    # interrupted run sent one
     #
+    @log_stage('alert')
     def emailer2(self, ticket, advertiser):
-        cm_email2 = EmailManager(ticket, advertiser, self.email_subject, self.email_to, self.email_from,
-                                 self.email_cc, self.excel_file_name, self.data_source)
-        cm_email2.cm_emailer2()
+        if self.alert_digest is not None:
+            self.alert_digest.add_alert('progress', ticket, advertiser)
+            return
+        cm_email2 = self.notifications().EmailManager(ticket, advertiser, self.email_subject, self.email_to,
+                                                      self.email_from, self.email_cc, self.excel_file_name,
+                                                      self.data_source, self.smtp_host)
+        self.dispatcher().dispatch(cm_email2.progress_alert_message(), 'ticket {}'.format(ticket.key),
+                                   lambda: self.journal.record(ticket.key, 'emailed'))
+
+    # Returns the email module, the notification backend is imported with the first alert
+    #
+    def notifications(self):
+        return self.backends.load('notification', 'smtp')
 
-    # Checks the log directory for all files and removes those after a specified number of days
+    # Returns the background email dispatcher, started with the first alert of the process
+    #
+    def dispatcher(self):
+        with self.email_dispatch_lock:
+            if self.email_dispatch is None:
+                self.email_dispatch = self.notifications().EmailDispatchManager(self.smtp_host,
+                                                                                *self.email_dispatch_params)
+            return self.email_dispatch
+
+    # Queues the alerts collected during the run as one digest email, in digest mode
+    #
+    def alert_digest_send(self):
+        if self.alert_digest is None:
+            return
+        msg = self.alert_digest.digest_message()
+        if msg is not None:
+            keys = self.alert_digest.alert_keys()
+            self.dispatcher().dispatch(msg, 'the digest of {} ticket(s)'.format(len(keys)),
+                                       lambda: [self.journal.record(key, 'emailed') for key in keys])
+        self.alert_digest = None
+
+    # Sweeps the log directory, the log, journal and metrics files are compressed after compress_days and removed
+    # after the specified number of days. In the background the sweep runs alongside the tickets, see RetentionManager
     #
     def purge_files(self, purge_days, purge_dir):
-        try:
-            self.logger.info("")
-            self.logger.info("Remove {} days old files from the {} directory".format(purge_days, purge_dir))
-            now = time.time()
-            for file_purge in os.listdir(purge_dir):
-                f_obs_path = os.path.join(purge_dir, file_purge)
-                if os.stat(f_obs_path).st_mtime < now - int(purge_days) * 86400 and f_obs_path.split(".")[-1] == "log":
-                    time_stamp = time.strptime(time.strftime('%Y-%m-%d %H:%M:%S',
-                                                             time.localtime(os.stat(f_obs_path).st_mtime)),
-                                               '%Y-%m-%d %H:%M:%S')
-                    self.logger.info("Removing File [{}] with timestamp [{}]".format(f_obs_path, time_stamp))
-
-                    os.remove(f_obs_path)
-
-        except Exception as e:
-            self.logger.error("{}".format(e))
+        if self.retention is not None and self.retention.is_running():
+            self.logger.info("The last retention sweep of %s is still running", purge_dir)
+            return
+        self.retention = RetentionManager(purge_dir, purge_days, self.compress_days)
+        if self.retention_background:
+            self.retention.start()
+        else:
+            self.retention.sweep()
@@ -4,15 +4,27 @@
 # posting and field updating.
 #
 from jira import JIRA
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import date
 from urllib.parse import urlparse
+import json
 import logging
+import re
+
+from metrics_manager import metrics
+from throttle_manager import ThrottleManager
 
 
 class JiraManager(object):
-    def __init__(self, url, jira_token):
+    def __init__(self, url, jira_token, page_size=100, watcher_concurrency=5, throttle=None):
         self.tickets = []
-        self.jira = JIRA(url, basic_auth=jira_token)
+        self.url = url
+        self.jira_token = jira_token
+        self.jira = None        # opened by connect
+        # every Jira request is paced and retried by the throttle, the client's own retries are turned off
+        self.throttle = throttle if throttle is not None else ThrottleManager()
+        self.page_size = page_size
+        self.watcher_pool = ThreadPoolExecutor(max_workers=watcher_concurrency, thread_name_prefix='JiraWatcher')
         self.date_range = ""
         self.file_name = ""
         self.hub_study_number = ""
@@ -22,6 +34,18 @@ class JiraManager(object):
         self.media_partner = None
         self.advertiser_id = None
         self.media_partners = ['YouTube', 'Snapchat, Inc.', 'Spotify']
+        # only the ticket fields used by the automation are requested from the search, see ticket_snapshot
+        self.search_fields = ['customfield_10414',     # advertiser
+                              'customfield_17018',     # hub study link
+                              'customfield_17028',     # media partner - HUB
+                              'customfield_11492',     # parent id
+                              'customfield_12325',     # lead analyst
+                              'reporter',
+                              'status',
+                              'updated']
+        self.snapshots = dict()
+        self.field_ids = dict()
+        self.ticket_varieties = ['Standard', 'YouTube', 'In-Flight ROI', 'Retail']
         self.today_date = date.today().strftime('%Y-%m-%d')  # format required for Jira date field
         self.logger = logging.getLogger(__name__)
 
@@ -39,9 +63,11 @@ class JiraManager(object):
         self.date_field = 'customfield_10418'   # end date
         self.date_field = 'customfield_11426'   # post-period end date
 
-    # Searches Jira for all tickets that match the ticket query criteria
+    # Streams all tickets that match the ticket query criteria, page by page, limited to the tickets updated in the last
+    # 'updated_within' minutes when given, along with the pending tickets left unfinished by the last run
     #
-    def find_tickets(self, ticket_type, project, reporter, issue_type, vertical, status, product, media_partner):
+    def search_tickets(self, ticket_type, project, reporter, issue_type, vertical, status, product, media_partner,
+                       updated_within=None, pending_keys=None):
         # Search Jira to find corresponding tickets, jql searches for 1 of 3 different ticket types
         if ticket_type == 'Standard':
             jql_query = 'project = {} AND reporter IN {} AND issuetype IN {} AND vertical IN {} AND status = {} ' \
@@ -60,66 +86,256 @@ class JiraManager(object):
                         'AND "Media Partner - HUB" NOT IN {} AND NOT summary ~ "test*"'\
                         .format(project, issue_type, vertical, status, media_partner)
 
-        self.tickets = self.jira.search_issues(jql_query, maxResults=500)
+        for ticket in self.search_pages(self.updated_filter(jql_query, updated_within, pending_keys),
+                                        self.search_fields, not pending_keys):
+            yield ticket
+
+    # Adds an 'updated' predicate to a jql query, a relative duration avoids any timezone difference with the server.
+    # Pending ticket keys are searched whatever their update time
+    #
+    @staticmethod
+    def updated_filter(jql_query, updated_within, pending_keys=None):
+        if updated_within is None:
+            return jql_query
+        if pending_keys:
+            return '{} AND (updated >= -{}m OR key IN ({}))'.format(jql_query, updated_within, ', '.join(pending_keys))
+        return '{} AND updated >= -{}m'.format(jql_query, updated_within)
+
+    # Pages through every result of a jql search, the next page is fetched in the background while the tickets of
+    # the current page are handed out, each ticket is snapshotted as it arrives. Pages are keyed on the last ticket key
+    # seen rather than on startAt, processed tickets leave the 'Open' result set and would otherwise shift the offsets.
+    # Without validation a ticket key that no longer exists is dropped by Jira with a warning rather than an error
+    #
+    def search_pages(self, jql_query, fields, validate=True):
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='JiraPrefetch') as prefetch:
+            page = prefetch.submit(self.search_page, jql_query, None, fields, validate)
+            while page is not None:
+                tickets = page.result()
+                more = len(tickets) > 0 and getattr(tickets, 'total', len(tickets)) > len(tickets)
+                page = prefetch.submit(self.search_page, jql_query, tickets[-1].key, fields, validate) if more else None
+
+                for ticket in tickets:
+                    self.snapshots[ticket.key] = self.ticket_snapshot(ticket)
+                    yield ticket
+
+    # Fetches a single page of search results, ordered by key and starting after the given ticket key
+    #
+    def search_page(self, jql_query, after_key, fields, validate=True):
+        if after_key is not None:
+            jql_query = '({}) AND key > {}'.format(jql_query, after_key)
+        metrics.count('jira.search')
+        with metrics.span('jira search'):
+            return self.throttle.call(self.jira.search_issues, '{} ORDER BY key ASC'.format(jql_query), startAt=0,
+                                      maxResults=self.page_size, validate_query=validate, fields=','.join(fields))
+
+    # Streams the union search as (ticket variety, ticket) pairs, tickets matching no variety are logged and dropped
+    #
+    def search_tickets_combined(self, project, reporter, issue_type, vertical, vertical2, status, product,
+                                media_partner, updated_within=None, pending_keys=None):
+        jql_query = 'project = {} AND issuetype IN {} AND status = {} AND NOT summary ~ "test*" ' \
+                    'AND ((reporter IN {} AND vertical IN {}) ' \
+                    'OR (vertical IN {} AND "Media Partner - HUB" NOT IN {}))'\
+                    .format(project, issue_type, status, reporter, vertical, vertical2, media_partner)
+
+        vertical_id = self.field_id('vertical')
+        product_id = self.field_id('product')
+        rules = {
+            "reporter":         set(self.jql_values(reporter)),
+            "vertical":         set(self.jql_values(vertical)),
+            "vertical2":        set(self.jql_values(vertical2)),
+            "product":          set(self.jql_values(product)),
+            "media_partner":    set(self.jql_values(media_partner))
+        }
+        jql_query = self.updated_filter(jql_query, updated_within, pending_keys)
+        for ticket in self.search_pages(jql_query, self.search_fields + [vertical_id, product_id], not pending_keys):
+            variety = self.classify_ticket(ticket, vertical_id, product_id, rules)
+            if variety is not None:
+                yield variety, ticket
+            else:
+                self.logger.warning("Ticket %s matched the combined search but no ticket variety", ticket.key)
+
+    # Applies the search_tickets variety predicates to a ticket, as in JQL a 'NOT IN' test fails on an empty field
+    #
+    def classify_ticket(self, ticket, vertical_id, product_id, rules):
+        reporter = self.field_values(getattr(ticket.fields, 'reporter', None))
+        vertical = self.field_values(getattr(ticket.fields, vertical_id, None))
+        product = self.field_values(getattr(ticket.fields, product_id, None))
+        media_partner = self.field_values(getattr(ticket.fields, 'customfield_17028', None))
 
-        if len(self.tickets) > 0:
-            return self.tickets
-        else:
+        if self.jql_in(vertical, rules['vertical2']) and self.jql_not_in(media_partner, rules['media_partner']):
+            return 'Retail'
+        if not self.jql_in(reporter, rules['reporter']) or not self.jql_in(vertical, rules['vertical']):
             return None
+        if self.jql_not_in(product, rules['product']):
+            if self.jql_not_in(media_partner, rules['media_partner']):
+                return 'Standard'
+            if self.jql_in(media_partner, rules['media_partner']):
+                return 'YouTube'
+        elif self.jql_in(product, rules['product']) and self.jql_not_in(media_partner, rules['media_partner']):
+            return 'In-Flight ROI'
+        return None
+
+    # Looks up the custom field id for a field name such as 'vertical', the field list is fetched once per session
+    #
+    def field_id(self, field_name):
+        if not self.field_ids:
+            for field in self.throttle.call(self.jira.fields):
+                self.field_ids[field['name'].lower()] = field['id']
+                for clause_name in field.get('clauseNames', []):
+                    self.field_ids.setdefault(clause_name.lower(), field['id'])
+        return self.field_ids[field_name.lower()]
+
+    # Converts a jql value list as held in config.ini, e.g. ('CPG Retail', 'Retail') or (app_p_jira_sugar), to a list
+    #
+    @staticmethod
+    def jql_values(jql_list):
+        values = re.findall(r"'([^']*)'|\"([^\"]*)\"|([^,'\"()\s][^,()]*)", jql_list.strip())
+        return [next(v for v in value if v).strip() for value in values]
+
+    # Reduces a ticket field value, a user, option, string or a list of these, to a set of comparable strings
+    #
+    @staticmethod
+    def field_values(value):
+        if value is None:
+            return set()
+        if not isinstance(value, list):
+            value = [value]
+        values = set()
+        for item in value:
+            for attribute in ('name', 'key', 'value'):
+                if getattr(item, attribute, None) is not None:
+                    values.add(str(getattr(item, attribute)))
+            if isinstance(item, (str, int, float)):
+                values.add(str(item))
+        return values
+
+    @staticmethod
+    def jql_in(values, allowed):
+        return len(values & allowed) > 0
+
+    @staticmethod
+    def jql_not_in(values, excluded):
+        return len(values) > 0 and len(values & excluded) == 0
+
+    # Captures the searched ticket field values once, all of the pull methods read from this snapshot
+    #
+    @staticmethod
+    def ticket_snapshot(ticket):
+        return {
+            "advertiser":       getattr(ticket.fields, 'customfield_10414', None),
+            "study_link":       getattr(ticket.fields, 'customfield_17018', None),
+            "media_partner":    getattr(ticket.fields, 'customfield_17028', None),
+            "advertiser_id":    getattr(ticket.fields, 'customfield_11492', None),
+            "lead_analyst":     getattr(ticket.fields, 'customfield_12325', None),
+            "reporter":         getattr(ticket.fields, 'reporter', None),
+            "status":           getattr(ticket.fields, 'status', None),
+            "updated":          getattr(ticket.fields, 'updated', None)
+        }
+
+    # Drops the snapshots of the previous run, a long-running service would otherwise keep every ticket it has seen
+    #
+    def reset_snapshots(self):
+        self.snapshots = dict()
+
+    # Returns the snapshot for a ticket, a ticket that did not come through a search is fetched once
+    #
+    def snapshot(self, ticket):
+        if ticket.key not in self.snapshots:
+            issue = self.throttle.call(self.jira.issue, ticket.key, fields=','.join(self.search_fields))
+            self.snapshots[ticket.key] = self.ticket_snapshot(issue)
+        return self.snapshots[ticket.key]
 
     # Retrieves the hub study number from ticket to populate api study call convert to integer type, also returns
     # the post-period end date and start date for hive query
     #
     def ticket_information_pull(self, ticket):
-        ticket = self.jira.issue(ticket.key)
-        self.advertiser = ticket.fields.customfield_10414
+        snapshot = self.snapshot(ticket)
+        advertiser = snapshot['advertiser']
         # Converts field value returned link url to tuple via urlparse, selects the item that represents the path [-4],
         # parse this item before selecting the last item [-1] from this string after splitting on '/'
-        self.hub_study_number = int(urlparse(ticket.fields.customfield_17018)[-4].split('/')[-1].strip())
+        hub_study_number = int(urlparse(snapshot['study_link'])[-4].split('/')[-1].strip())
 
-        return self.advertiser, self.hub_study_number
+        return advertiser, hub_study_number
 
     # Retrieves the media partner - HUB from the jira ticket field
     #
     def media_partner_pull(self, ticket, advertiser):
-        ticket = self.jira.issue(ticket.key)
-        self.media_partner = ticket.fields.customfield_17028
-        if self.media_partner not in self.media_partners or advertiser != 'Pepsico':
-            self.media_partner = None
-        return self.media_partner
+        media_partner = self.snapshot(ticket)['media_partner']
+        if media_partner not in self.media_partners or advertiser != 'Pepsico':
+            media_partner = None
+        return media_partner
 
     # Retrieves the pid from the jira ticket field
     #
     def pid_info_pull(self, ticket):
-        ticket = self.jira.issue(ticket.key)
-        self.advertiser_id = ticket.fields.customfield_11492
-        return self.advertiser_id
+        return self.snapshot(ticket)['advertiser_id']
 
-    # Add/Update Lead Analyst
+    # Add Watcher, a POST that is safe to retry as adding a watcher twice leaves the ticket unchanged
     #
-    def update_field(self, ticket, cf_name, user_name):
-        if cf_name == 'lead analyst' and ticket.fields.customfield_12325 is not None:
-            self.logger.info("Lead Analyst has already been assigned: {}".format(ticket.fields.customfield_12325))
-        else:
-            ticket.update(fields={'customfield_12325': {'name': user_name}})
-            self.logger.info("Lead Analyst has been updated to : {}".format(user_name))
+    def add_watcher(self, ticket, user_name):
+        self.throttle.call(self.jira.add_watcher, ticket, user_name)
 
-    # Add Watcher
+    # Starts a set of ticket changes that are collected, then written together by commit_update
     #
-    def add_watcher(self, ticket, user_name):
-        self.jira.add_watcher(ticket, user_name)
+    def new_update(self, ticket):
+        return TicketUpdate(ticket)
 
-    @staticmethod
-    # Add/Update Reporter
+    # Writes the collected reporter and lead analyst changes in a single issue update, then adds the watchers
+    # concurrently. Only the changes that differ from the ticket's current state are written. Every watcher add is
+    # attempted, the first failure is raised once all have finished. The update is a plain PUT on the Jira session,
+    # Issue.update would follow it with a 4s sleep and a reload while holding a throttle slot, and the automation does
+    # not read the ticket back
     #
-    def update_reporter(ticket, user_name):
-        ticket.update(reporter={'name': user_name})
+    def commit_update(self, update):
+        fields, watchers = self.diff_update(update)
+        skipped = len(update.fields) + len(update.watchers) - len(fields) - len(watchers)
+        self.logger.info("%s write(s) to make, %s write(s) skipped", len(fields) + len(watchers), skipped)
 
-    # Update the field 'Due Date' in the ticket to today's date
+        if len(fields) > 0:
+            metrics.count('jira.issue_update')
+            with metrics.span('jira field write'):
+                self.throttle.call(self.jira._session.put, update.ticket.self, data=json.dumps({"fields": fields}))
+            if 'customfield_12325' in fields:
+                self.logger.info("Lead Analyst has been updated to : %s", fields['customfield_12325']['name'])
+
+        futures = list()
+        if len(watchers) > 0:
+            metrics.count('jira.watcher_add', len(watchers))
+            with metrics.span('jira watcher add'):
+                futures = [self.watcher_pool.submit(self.add_watcher, update.ticket.key, user_name)
+                           for user_name in watchers]
+                wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    # Compares the collected changes with the ticket's current reporter, lead analyst and watchers, returns only the
+    # field changes and watchers that would change something
     #
-    def update_date_field(self, ticket):
-        ticket.fields.due_date = self.today_date
-        ticket.update(fields={'duedate': ticket.fields.due_date})
+    def diff_update(self, update):
+        ticket = update.ticket
+        fields = dict()
+        for field, value in update.fields.items():
+            current = getattr(ticket.fields, field, None)
+            if field == 'customfield_12325' and current is not None:
+                self.logger.info("Lead Analyst has already been assigned: %s", current)
+            elif field in ('reporter', 'customfield_12325') and getattr(current, 'name', None) == value['name']:
+                continue
+            else:
+                fields[field] = value
+
+        watchers = [user_name for user_name in update.watchers if user_name is not None]
+        if len(watchers) > 0:
+            try:
+                metrics.count('jira.watchers_get')
+                with metrics.span('jira watchers get'):
+                    ticket_watchers = self.throttle.call(self.jira.watchers, ticket.key)
+                    current = set(watcher.name for watcher in ticket_watchers.watchers)
+            except Exception as e:
+                self.logger.warning("Could not read the watchers of ticket %s, adding all => %s", ticket.key, e)
+            else:
+                watchers = [user_name for user_name in watchers if user_name not in current]
+        return fields, watchers
 
     # Reassign Ticket
     #
@@ -148,13 +364,52 @@ class JiraManager(object):
                                 )
         self.jira.add_comment(issue=cam_ticket, body=message)'''
 
-    # Transition the ticket to one of five statuses, see above to set selection
+    # Transition the ticket to one of five statuses, see above to set selection, the transition is posted directly
+    # against the ticket key so no issue fetch is needed. A transition is not idempotent, it is retried only when
+    # rejected with 429
     #
     def progress_ticket(self, ticket_key):
-        ticket = self.jira.issue(ticket_key)
-        self.jira.transition_issue(ticket, self.ticket_transitionid)
+        metrics.count('jira.transition')
+        with metrics.span('jira progress'):
+            self.throttle.call(self.jira.transition_issue, ticket_key, self.ticket_transitionid, idempotent=False)
+
+    # Opens the JIRA session, including its server info round trip, unless already open. The timeout also bounds each
+    # later request of the session
+    #
+    def connect(self, timeout=None):
+        if self.jira is None:
+            self.jira = self.throttle.call(JIRA, self.url, basic_auth=self.jira_token, timeout=timeout, max_retries=0)
 
     # Ends the current JIRA session
     #
     def kill_session(self):
-        self.jira.kill_session()
+        self.watcher_pool.shutdown()
+        if self.jira is not None:
+            self.jira.kill_session()
+            self.jira = None
+
+
+# Module holds the class => TicketUpdate - collects the field changes and watchers for a single ticket
+# Class responsible for building the payload written by JiraManager.commit_update
+#
+class TicketUpdate(object):
+    def __init__(self, ticket):
+        self.ticket = ticket
+        self.fields = dict()
+        self.watchers = list()
+
+    # Add/Update Reporter
+    #
+    def set_reporter(self, user_name):
+        self.fields['reporter'] = {'name': user_name}
+
+    # Add Lead Analyst, an already assigned Lead Analyst is left in place by JiraManager.diff_update
+    #
+    def set_lead_analyst(self, user_name):
+        self.fields['customfield_12325'] = {'name': user_name}
+
+    # Add Watcher
+    #
+    def add_watcher(self, user_name):
+        if user_name not in self.watchers:
+            self.watchers.append(user_name)
@@ -0,0 +1,155 @@
+# journal_manager module
+# Module holds the class => JournalManager - manages the per-run ticket checkpoint journal
+# Class responsible for the append-only journal file kept next to the logs, one JSON record per line for each ticket
+# stage completed during a run -> resolved, populated, progressed, emailed. The last record of a finished run marks the
+# run complete. A resumed run reads the latest journal without that record and skips the stages it already lists.
+# The file is only created with the first record, a run that handles no tickets, e.g. an empty service poll, leaves
+# no journal behind.
+#
+from datetime import datetime
+from glob import glob
+import json
+import logging
+import os
+import threading
+
+
+class JournalManager(object):
+    def __init__(self, directory, app_name):
+        self.directory = directory
+        self.app_name = app_name
+        self.journal_file_name = None
+        self.journal_file = None
+        self.journal_failed = False
+        self.stages = dict()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    # Opens the journal for a run, on resume the latest journal is continued when it has no completion record,
+    # otherwise a new journal is started once the first stage is recorded
+    #
+    def open_journal(self, resume=False):
+        self.stages = dict()
+        self.journal_file_name = None
+        self.journal_file = None
+        self.journal_failed = False
+        if resume:
+            journal_file_name = self.latest_journal()
+            if journal_file_name is not None and self.journal_read(journal_file_name):
+                self.journal_file_name = journal_file_name
+                self.logger.info("Resuming the interrupted run from journal %s, %s ticket(s) recorded",
+                                 journal_file_name, len(self.stages))
+            else:
+                self.logger.info("No interrupted run to resume, starting a new run")
+        if self.journal_file_name is None:
+            self.journal_file_name = '{}{}_{}.journal'.format(self.directory, self.app_name,
+                                                              datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+
+    # Creates or reopens the journal file on the first record of the run, called with the lock held. A journal that
+    # cannot be opened is not tried again for the rest of the run
+    #
+    def journal_open(self):
+        if self.journal_file is None and not self.journal_failed and self.journal_file_name is not None:
+            try:
+                # line buffered, each record reaches the file as soon as it is written
+                self.journal_file = open(self.journal_file_name, 'a', buffering=1)
+            except OSError as e:
+                self.logger.warning("Journal %s is unavailable, this run cannot be resumed => %s",
+                                    self.journal_file_name, e)
+                self.journal_failed = True
+        return self.journal_file
+
+    # Returns the name of the most recent journal, or None. Only the journals of complete runs are compressed by the
+    # log directory sweep, a compressed journal being the most recent means there is no run to resume
+    #
+    def latest_journal(self):
+        journal_file_names = glob('{}{}_*.journal'.format(self.directory, self.app_name)) + \
+            glob('{}{}_*.journal.gz'.format(self.directory, self.app_name))
+        if len(journal_file_names) == 0:
+            return None
+        journal_file_name = max(journal_file_names, key=os.path.getmtime)
+        if journal_file_name.endswith('.gz'):
+            return None
+        return journal_file_name
+
+    # Checks whether a journal ends with the completion record of its run, only the last line is read
+    #
+    @staticmethod
+    def journal_complete(journal_file_name):
+        with open(journal_file_name, 'rb') as journal_file:
+            journal_file.seek(0, os.SEEK_END)
+            journal_file.seek(max(journal_file.tell() - 4096, 0))
+            lines = journal_file.read().splitlines()
+        try:
+            return len(lines) > 0 and json.loads(lines[-1].decode()).get('stage') == 'complete'
+        except ValueError:
+            return False
+
+    # Reads the stages recorded in a journal, returns False when the journal records a complete run. A partly written
+    # last line, left by a process killed mid write, is ignored
+    #
+    def journal_read(self, journal_file_name):
+        stages = dict()
+        try:
+            with open(journal_file_name) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('stage') == 'complete':
+                        return False
+                    stages.setdefault(record['ticket'], dict())[record['stage']] = record.get('data')
+        except Exception as e:
+            self.logger.warning("Unreadable journal %s => %s", journal_file_name, e)
+            return False
+        self.stages = stages
+        return True
+
+    # Checks whether the stage was completed for the ticket by the interrupted run being resumed
+    #
+    def completed(self, key, stage):
+        return stage in self.stages.get(key, dict())
+
+    # Returns the data recorded with a completed stage
+    #
+    def stage_data(self, key, stage):
+        return self.stages.get(key, dict()).get(stage)
+
+    # Appends a completed stage for a ticket, with any data needed to skip the stage on resume. Only the stages read
+    # from the resumed journal are skipped, those recorded during this run are not
+    #
+    def record(self, key, stage, data=None):
+        record = {
+            "ticket":   key,
+            "stage":    stage,
+            "at":       datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "data":     data
+        }
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.journal_open() is not None:
+                try:
+                    self.journal_file.write(line + '\n')
+                except OSError as e:
+                    self.logger.warning("Journal write failed for ticket %s => %s", key, e)
+
+    # Closes the journal, a completed run is marked so that it is not resumed
+    #
+    def close_journal(self, complete):
+        with self.lock:
+            # a resumed journal is marked complete even when this run recorded nothing more
+            if complete and len(self.stages) > 0:
+                self.journal_open()
+            if self.journal_file is None:
+                return
+            try:
+                if complete:
+                    self.journal_file.write(json.dumps({"stage": "complete",
+                                                        "at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+                self.journal_file.close()
+            except OSError as e:
+                self.logger.warning("Journal close failed for %s => %s", self.journal_file_name, e)
+            self.journal_file = None
+        if not complete:
+            self.logger.info("Run incomplete, it may be resumed from journal %s", self.journal_file_name)
@@ -0,0 +1,145 @@
+# log_manager module
+# Module holds the class => LogManager - manages the asynchronous run log
+# Class responsible for the log file set up, the calling threads only put each log record on an in-memory queue and a
+# single listener thread writes the records to the log file on the network mount, so that a slow mount no longer adds
+# to the time spent on each ticket. The log is written either as text lines or as one JSON object per line, the JSON
+# lines carry the ticket key, ticket variety and stage of the record, which are held per thread in 'log_context'.
+#
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+
+TEXT_FORMAT = '%(asctime)s: %(levelname)-7s: %(name)-30s: %(threadName)-12s: %(message)s'
+DATE_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+
+class LogContext(threading.local):
+    def __init__(self):
+        self.ticket = None
+        self.variety = None
+        self.stage = None
+
+    # Tags the log records of the current thread with the ticket being processed and its variety
+    #
+    def bind(self, ticket=None, variety=None):
+        self.ticket = ticket
+        self.variety = variety
+        self.stage = None
+
+    def clear(self):
+        self.bind()
+
+    # Tags the log records of the enclosed block with the stage, the enclosing stage is restored afterwards
+    #
+    @contextmanager
+    def in_stage(self, stage):
+        previous = self.stage
+        self.stage = stage
+        try:
+            yield
+        finally:
+            self.stage = previous
+
+
+log_context = LogContext()
+
+
+# Decorates a method so that the log records written while it runs are tagged with the stage
+#
+def log_stage(stage):
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with log_context.in_stage(stage):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Copies the ticket context of the calling thread onto each record, before the record is queued for the listener
+#
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.ticket = log_context.ticket
+        record.variety = log_context.variety
+        record.stage = log_context.stage
+        return True
+
+
+# Formats each record as one JSON object per line
+#
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "time":     '{}.{:03d}'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                                           int(record.msecs)),
+            "level":    record.levelname,
+            "logger":   record.name,
+            "thread":   record.threadName,
+            "ticket":   getattr(record, 'ticket', None),
+            "variety":  getattr(record, 'variety', None),
+            "stage":    getattr(record, 'stage', None),
+            "message":  record.getMessage()
+        }
+        return json.dumps(line, default=str)
+
+
+class LogManager(object):
+    def __init__(self, logfile_name, log_format='text'):
+        self.logfile_name = logfile_name
+        self.log_format = log_format
+        self.queue = queue.Queue()
+        self.queue_handler = None
+        self.file_handler = None
+        self.listener = None
+
+    # Routes the root logger through the queue and starts the listener thread writing to the log file
+    #
+    def start(self):
+        self.open_file()
+        self.queue_handler = QueueHandler(self.queue)
+        self.queue_handler.addFilter(ContextFilter())
+        root_logger = logging.getLogger('')
+        root_logger.setLevel(logging.INFO)
+        root_logger.addHandler(self.queue_handler)
+        self.listener.start()
+        # the listener thread is a daemon, the queued records are still written on an unplanned exit
+        atexit.register(self.stop)
+
+    # Opens the log file and sets up the listener thread writing to it
+    #
+    def open_file(self):
+        self.file_handler = logging.FileHandler(self.logfile_name)
+        if self.log_format == 'json':
+            self.file_handler.setFormatter(JSONFormatter())
+        else:
+            self.file_handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+        self.listener = QueueListener(self.queue, self.file_handler, respect_handler_level=True)
+
+    # Switches the log to a new file, the records queued while the listener is stopped are written to the new file
+    #
+    def rotate(self, logfile_name):
+        if self.listener is None or logfile_name == self.logfile_name:
+            return
+        self.listener.stop()
+        self.file_handler.close()
+        self.logfile_name = logfile_name
+        self.open_file()
+        self.listener.start()
+
+    # Writes out the records still queued, then stops the listener thread and closes the log file
+    #
+    def stop(self):
+        if self.listener is None:
+            return
+        logging.getLogger('').removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.file_handler.close()
+        self.listener = None
+        atexit.unregister(self.stop)
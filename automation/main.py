@@ -22,6 +22,15 @@
 #                       excel_manager.py,
 #                       jira_manager.py,
 #                       email_manager.py,
+#                       mysql_manager.py,
+#                       cache_manager.py,
+#                       watermark_manager.py,
+#                       journal_manager.py,
+#                       metrics_manager.py,
+#                       log_manager.py,
+#                       backend_manager.py,
+#                       retention_manager.py,
+#                       throttle_manager.py,
 #                       config.ini
 # Deployed Location:    //prd-use1a-pr-34-ci-operations-01/home/bradley.ruck/Projects/cpg_brand_input/
 # ActiveBatch Trigger:  //prd-09-abjs-01 (V11)/'Jobs, Folders & Plans'/Operations/Report/CPG_Brand_Input
@@ -38,18 +47,27 @@
 
 # main module
 # Responsible for reading in the basic configurations settings, creating the log file, and creating and launching
-# the Field Input Manager (FIM), finally it launches the purge_files method to remove log files that are older
-# than a prescribed retention period.
+# the Field Input Manager (FIM), it launches the purge_files method to compress and remove log files that are older
+# than the prescribed periods, optionally in the background alongside the run.
 # A console logger option is offered via keyboard input for development purposes when the main.py script is invoked.
 # For production, import main as a module and launch the main function as main.main(), which uses 'n' as the default
 # input to the the console logger run option.
+# A long-running service mode is launched as main.service() or 'main.py --service', the FIM and its connections are
+# kept open and the process manager is run once per poll interval until the process receives SIGTERM. The service
+# does not prompt for the console logger, 'main.py --console' enables it without the prompt.
+# Each run keeps a checkpoint journal of the ticket stages it completes, a run that was interrupted is resumed with
+# main.main(resume=True) or 'main.py --resume', which skips the stages already completed.
 #
 from datetime import datetime, timedelta
+import argparse
+import ast
 import os
 import configparser
 import logging
+import signal
 
 from field_input_manager import FieldInputManager
+from log_manager import LogManager
 
 
 # Define a console logger for development purposes
@@ -65,9 +83,9 @@ def console_logger():
     logging.getLogger('').addHandler(console)
 
 
-def main(con_opt='n'):
-    today_date = (datetime.now() - timedelta(hours=6)).strftime('%Y%m%d-%H%M%S')
-
+# Read the config.ini file and return it along with a dictionary of the configuration parameters for the FIM
+#
+def read_config():
     # create a configparser object and open in read mode
     config = configparser.ConfigParser()
     config.read('config.ini')
@@ -75,6 +93,7 @@ def main(con_opt='n'):
     # create a dictionary of configuration parameters
     config_params = {
         "data_source":          config.get('Project Details', 'data_source'),
+        "workers":              config.getint('Project Details', 'workers', fallback=1),
         "jira_url":             config.get('Jira', 'url'),
         "jira_token":           tuple(config.get('Jira', 'authorization').split(',')),
         "jql_project":          config.get('Jira', 'project'),
@@ -88,16 +107,86 @@ def main(con_opt='n'):
         "jql_filter1":          config.get('Jira', 'generic_filter1'),
         "jql_filter2":          config.get('Jira', 'generic_filter2'),
         "jql_brand_list":       list(config.get('Jira', 'brand_list').split(',')),
+        "jira_page_size":       config.getint('Jira', 'page_size', fallback=100),
+        "watcher_concurrency":  config.getint('Jira', 'watcher_concurrency', fallback=5),
+        "jira_throttle":        (config.getfloat('Jira', 'request_rate', fallback=20),
+                                 config.getfloat('Jira', 'request_burst', fallback=10),
+                                 config.getint('Jira', 'max_concurrency', fallback=8),
+                                 config.getint('Jira', 'min_concurrency', fallback=1),
+                                 config.getint('Jira', 'throttle_retries', fallback=5),
+                                 config.getfloat('Jira', 'throttle_backoff', fallback=1),
+                                 config.getfloat('Jira', 'max_backoff', fallback=60)),
+        "jql_search_mode":      config.get('Jira', 'search_mode', fallback='separate'),
+        "jql_incremental":      config.getboolean('Jira', 'incremental', fallback=False),
+        "full_sweep_days":      config.getfloat('Jira', 'full_sweep_days', fallback=7),
+        "watermark_overlap":    config.getfloat('Jira', 'watermark_overlap_minutes', fallback=30),
+        "watermark_path":       '{}watermark.json'.format(config.get('LogFile', 'path')),
+        "journal_path":         config.get('LogFile', 'path'),
+        "app_name":             config.get('Project Details', 'app_name'),
+        "compress_days":        config.getfloat('LogFile', 'compress_days', fallback=0),
+        "retention_background": config.getboolean('LogFile', 'background_sweep', fallback=False),
+        "metrics_path":         config.get('LogFile', 'path') if config.getboolean('LogFile', 'metrics', fallback=True)
+                                else None,
         "study_url":            config.get('Api', 'study_url', raw=True),
         "account_url":          config.get('Api', 'account_url', raw=True),
+        "api_concurrency":      config.getint('Api', 'concurrency', fallback=8),
+        "api_resilience":       (config.getfloat('Api', 'connect_timeout', fallback=5),
+                                 config.getfloat('Api', 'read_timeout', fallback=30),
+                                 config.getint('Api', 'retries', fallback=2),
+                                 config.getfloat('Api', 'retry_backoff', fallback=0.5),
+                                 config.getfloat('Api', 'breaker_error_rate', fallback=0.5),
+                                 config.getint('Api', 'breaker_min_calls', fallback=10),
+                                 config.getint('Api', 'breaker_window', fallback=20)),
+        "study_cache_path":     config.get('StudyCache', 'path', fallback='') or
+                                '{}study_cache.sqlite'.format(config.get('LogFile', 'path')),
+        "study_cache_ttl":      config.getfloat('StudyCache', 'ttl_days', fallback=30),
+        "study_cache_neg_ttl":  config.getfloat('StudyCache', 'negative_ttl_days', fallback=1),
+        "study_cache_size":     config.getint('StudyCache', 'max_entries', fallback=5000),
         "excel_file":           config.get('ExcelFile', 'path'),
-        "db_config":            config.get('MySQL', 'db_config'),
+        "db_config":            ast.literal_eval(config.get('MySQL', 'db_config')),
+        "db_pool_size":         config.getint('MySQL', 'pool_size', fallback=2),
+        "db_retries":           config.getint('MySQL', 'connect_retries', fallback=3),
+        "db_retry_backoff":     config.getfloat('MySQL', 'retry_backoff', fallback=2),
+        "db_pool_timeout":      config.getfloat('MySQL', 'pool_timeout', fallback=30),
         "email_subject":        config.get('Email', 'subject'),
         "email_to":             config.get('Email', 'to'),
         "email_from":           config.get('Email', 'from'),
-        "email_cc":             config.get('Email', 'cc')
+        "email_cc":             config.get('Email', 'cc'),
+        "smtp_host":            config.get('Email', 'smtp_host', fallback='mailhost.valkyrie.net'),
+        "alert_mode":           config.get('Email', 'alert_mode', fallback='ticket'),
+        "email_queue_size":     config.getint('Email', 'queue_size', fallback=100),
+        "email_retries":        config.getint('Email', 'send_retries', fallback=3),
+        "email_retry_backoff":  config.getfloat('Email', 'retry_backoff', fallback=2),
+        "email_idle_timeout":   config.getfloat('Email', 'idle_timeout', fallback=60),
+        "warm_up_timeouts":     {
+                                    "jira":             config.getfloat('WarmUp', 'jira_timeout', fallback=30),
+                                    "mysql":            config.getfloat('WarmUp', 'mysql_timeout', fallback=30),
+                                    "study_builder":    config.getfloat('WarmUp', 'study_builder_timeout', fallback=10),
+                                    "smtp":             config.getfloat('WarmUp', 'smtp_timeout', fallback=10)
+                                },
+        "warm_up_smtp":         config.getboolean('WarmUp', 'smtp', fallback=False)
     }
 
+    return config, config_params
+
+
+# Configure the log file, written from a background queue as text or JSON lines, and the optional console logger.
+# Returns the log manager, stopped at the end of the run to write out the queued records
+#
+def log_setup(logfile_name, con_opt, log_format='text'):
+    log_manager = LogManager(logfile_name, log_format)
+    log_manager.start()
+
+    # checks for console logger option, default value set to 'n' to not run in production
+    if con_opt and con_opt in ['y', 'Y']:
+        console_logger()
+    return log_manager
+
+
+def main(con_opt='n', resume=False):
+    today_date = (datetime.now() - timedelta(hours=6)).strftime('%Y%m%d-%H%M%S')
+    config, config_params = read_config()
+
     # logfile path to point to the Operations_limited drive on zfs
     purge_days = config.get('LogFile', 'retention_days')
     log_file_path = config.get('LogFile', 'path')
@@ -105,29 +194,97 @@ def main(con_opt='n'):
 
     # check to see if log file already exits for the day to avoid duplicate execution
     if not os.path.isfile(logfile_name):
-        logging.basicConfig(filename=logfile_name,
-                            level=logging.INFO,
-                            format='%(asctime)s: %(levelname)-7s: %(name)-30s: %(threadName)-12s: %(message)s',
-                            datefmt='%m/%d/%Y %H:%M:%S')
-
+        log_manager = log_setup(logfile_name, con_opt, config.get('LogFile', 'format', fallback='text'))
         logger = logging.getLogger(__name__)
 
-        # checks for console logger option, default value set to 'n' to not run in production
-        if con_opt and con_opt in ['y', 'Y']:
-            console_logger()
+        try:
+            logger.info("Process Start - Daily CPG Brand Input Automation - %s\n", today_date)
+
+            # create FIM object and launch the process manager, the log directory sweep for old log files to purge
+            # runs first, or alongside the tickets when run in the background
+            field_input = FieldInputManager(config_params)
+            field_input.purge_files(purge_days, log_file_path)
+            field_input.process_manager(resume)
+            field_input.shutdown()
+        finally:
+            log_manager.stop()
 
-        logger.info("Process Start - Daily CPG Brand Input Automation - {}\n".format(today_date))
 
-        # create FIM object and launch the process manager
-        field_input = FieldInputManager(config_params)
-        field_input.process_manager()
+# Long-running service mode, one FIM instance polls for tickets every poll interval, keeping its Jira session, data
+# source index and connection pools warm between polls. SIGTERM (or SIGINT) lets the tickets in progress finish and
+# then closes all connections. With resume the first poll resumes an interrupted run. A poll that handles no tickets
+# writes no journal or metrics report. The service logs to a new dated file each day, so that the files of the
+# previous days age and are compressed and purged by the log directory sweep
+#
+def service(con_opt='n', resume=False):
+    start_date = (datetime.now() - timedelta(hours=6)).strftime('%Y%m%d-%H%M%S')
+    config, config_params = read_config()
+
+    purge_days = config.get('LogFile', 'retention_days')
+    log_file_path = config.get('LogFile', 'path')
+    poll_interval = config.getfloat('Service', 'poll_interval', fallback=300)
+    log_date = start_date[:8]
+    logfile_name = '{}{}_service_{}.log'.format(log_file_path, config.get('Project Details', 'app_name'), start_date)
+    log_manager = log_setup(logfile_name, con_opt, config.get('LogFile', 'format', fallback='text'))
+    logger = logging.getLogger(__name__)
+
+    logger.info("Service Start - CPG Brand Input Automation - %s, polling every %ss\n", start_date, poll_interval)
+
+    field_input = FieldInputManager(config_params)
+    stop_event = field_input.stop_event
+
+    def request_stop(signum, frame):
+        logger.info("Signal %s received, stopping after the current poll", signum)
+        stop_event.set()
 
-        # search logfile directory for old log files to purge
-        field_input.purge_files(purge_days, log_file_path)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    purge_date = None
+    while not stop_event.is_set():
+        # switch to the log file of the day on the first poll after the date changes
+        poll_date = (datetime.now() - timedelta(hours=6)).strftime('%Y%m%d-%H%M%S')
+        if poll_date[:8] != log_date:
+            log_date = poll_date[:8]
+            logger.info("Continued in the log file of %s", log_date)
+            log_manager.rotate('{}{}_service_{}.log'.format(log_file_path, config.get('Project Details', 'app_name'),
+                                                            poll_date))
+            logger.info("Service continued - CPG Brand Input Automation - %s", poll_date)
+
+        logger.info("Poll Start - %s", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        try:
+            field_input.process_manager(resume, empty_report=False)
+        except Exception as e:
+            logger.error("Poll failed => %s", e)
+        resume = False
+
+        # search logfile directory for old log files to purge, once a day
+        if purge_date != datetime.now().date():
+            purge_date = datetime.now().date()
+            field_input.purge_files(purge_days, log_file_path)
+
+        stop_event.wait(poll_interval)
+
+    field_input.shutdown()
+    logger.info("Service Stop - CPG Brand Input Automation")
+    log_manager.stop()
 
 
 if __name__ == '__main__':
-    # prompt user for use of console logging -> for use in development not production
-    ans = input("\nWould you like to enable a console logger for this run?\n Please enter y or n:\t")
-    print()
-    main(ans)
+    parser = argparse.ArgumentParser(description='Measurement/CPG Brands - Field Input Automation')
+    parser.add_argument('--service', action='store_true', help='run as a long-running polling service')
+    parser.add_argument('--resume', action='store_true', help='resume the last interrupted run from its journal')
+    parser.add_argument('--console', action='store_true', help='enable the console logger without the prompt')
+    args = parser.parse_args()
+
+    # the service runs without a terminal, the console logger is only enabled there with --console
+    if args.service:
+        service('y' if args.console else 'n', args.resume)
+    else:
+        # prompt user for use of console logging -> for use in development not production
+        if args.console:
+            ans = 'y'
+        else:
+            ans = input("\nWould you like to enable a console logger for this run?\n Please enter y or n:\t")
+            print()
+        main(ans, args.resume)
@@ -0,0 +1,131 @@
+# metrics_manager module
+# Module holds the class => MetricsManager - collects the timing metrics of a run
+# Class responsible for the per-stage timing spans and the external call counters recorded by FieldInputManager and
+# the managers it calls, aggregated into count, total, p50, p95 and max per stage and written as a JSON report beside
+# the log at the end of each run. A single module level instance, 'metrics', is shared by all of the managers. The
+# one-off startup costs of the process, the backend imports and connections, are kept across runs.
+#
+from contextlib import contextmanager
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+
+class MetricsManager(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = dict()
+        self.counters = dict()
+        self.sections = dict()
+        self.startup = dict()
+        self.run_start = time.time()
+        self.logger = logging.getLogger(__name__)
+
+    # Starts the metrics over for a new run
+    #
+    def reset(self):
+        with self.lock:
+            self.timings = dict()
+            self.counters = dict()
+            self.sections = dict()
+            self.run_start = time.time()
+
+    # Times the enclosed block as one sample of the stage, an exception still records the time spent
+    #
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, list()).append(seconds)
+
+    # Times the enclosed block as a one-off startup cost, e.g. a backend import, reported with every run of the process
+    #
+    @contextmanager
+    def startup_span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_startup(name, time.perf_counter() - start)
+
+    def record_startup(self, name, seconds):
+        with self.lock:
+            self.startup[name] = round(seconds, 6)
+
+    # Counts an external call, e.g. 'jira.search' or 'smtp.send'
+    #
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Adds a named set of statistics to the report, e.g. the study cache hits and misses
+    #
+    def section(self, name, stats):
+        if stats is None:
+            return
+        with self.lock:
+            self.sections[name] = stats
+
+    # Returns count, total, p50, p95 and max for each stage
+    #
+    def stage_summary(self):
+        with self.lock:
+            timings = dict((stage, sorted(samples)) for stage, samples in self.timings.items())
+        summary = dict()
+        for stage, samples in timings.items():
+            summary[stage] = {
+                "count":    len(samples),
+                "total":    round(sum(samples), 6),
+                "p50":      round(self.percentile(samples, 50), 6),
+                "p95":      round(self.percentile(samples, 95), 6),
+                "max":      round(samples[-1], 6)
+            }
+        return summary
+
+    # Nearest-rank percentile of a sorted list of samples
+    #
+    @staticmethod
+    def percentile(samples, pct):
+        if len(samples) == 0:
+            return 0.0
+        return samples[max(0, int(math.ceil(pct / 100.0 * len(samples))) - 1)]
+
+    # Assembles the run report
+    #
+    def report(self):
+        stages = self.stage_summary()
+        with self.lock:
+            report = {
+                "run_start":    time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.run_start)),
+                "wall_time":    round(time.time() - self.run_start, 3),
+                "stages":       stages,
+                "calls":        dict(self.counters),
+                "startup":      dict(self.startup)
+            }
+            report.update(self.sections)
+        return report
+
+    # Writes the run report as JSON, to a temporary file first then swapped into place
+    #
+    def write_report(self, file_name):
+        temp_file_name = '{}.tmp'.format(file_name)
+        try:
+            with open(temp_file_name, 'w') as report_file:
+                json.dump(self.report(), report_file, indent=1, sort_keys=True, default=str)
+            os.replace(temp_file_name, file_name)
+        except Exception as e:
+            self.logger.warning("Unable to write metrics report %s => %s", file_name, e)
+        else:
+            self.logger.info("Run metrics written to %s", file_name)
+
+
+metrics = MetricsManager()
@@ -1,62 +1,226 @@
+# mysql_manager module
+# Module holds the class => MySQLManager - manages the MySQL database interface
+# Class responsible for all database interactions, connections are drawn from a small pool, each connection is
+# validated before use and a dropped connection is replaced with a new one, retried with backoff. Connections are made
+# with mysql.connector unless another connector is given, e.g. the benchmark's sqlite stand-in.
+#
+from contextlib import contextmanager
+import hashlib
+import json
 import mysql.connector
 from mysql.connector import errorcode
 import logging
-import sys
+import math
+import queue
+import re
+import threading
+import time
+
+from metrics_manager import metrics
 
 
 class MySQLManager(object):
-    def __init__(self, config, db_name):
-        self.cnx = None
-        self.cursor = None
+    def __init__(self, config, db_name, pool_size=2, retries=3, backoff=2, pool_timeout=30, connector=None):
         self.account_data = dict()
+        self.connector = connector if connector is not None else mysql.connector
+        self.assignments = dict()
+        self.assignments_fingerprint = None
         self.config = config
         self.DB_NAME = db_name
+        self.pool_size = max(1, int(pool_size))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.pool_timeout = float(pool_timeout)
+        self.pool = queue.LifoQueue()
+        self.pool_lock = threading.Lock()
+        self.open_connections = 0
+        self.pool_stats = {
+            "checkouts":        0,
+            "wait_total":       0.0,
+            "wait_max":         0.0,
+            "reconnects":       0
+        }
+        # errors after which a connection is discarded and the work retried on a new connection
+        self.transient_errors = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
         self.logger = logging.getLogger(__name__)
 
-    # Creates a new connection with MySQL server
+    # Opens the first pooled connection, confirming the credentials and database before any ticket is processed,
+    # raises mysql.connector.Error when no connection can be made, within the timeout in seconds when given
     #
-    def establish_connection(self):
-        # verify connection credentials
+    def establish_connection(self, timeout=None):
+        with self.pool_lock:
+            self.open_connections += 1
         try:
-            self.cnx = mysql.connector.connect(**self.config, auth_plugin='mysql_native_password')
-        except mysql.connector.Error as e:
-            if e.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                self.logger.error("Something is wrong with your user name or password")
-            elif e.errno == errorcode.ER_BAD_DB_ERROR:
-                self.logger.error("Database does not exist")
-            else:
-                self.logger.error(e)
-            sys.exit(1)
-        else:
-            self.cursor = self.cnx.cursor(buffered=True)
-            # attempts to connect to named database, if not exit, else confirm connection
+            cnx = self.new_connection(timeout)
+        except mysql.connector.Error:
+            with self.pool_lock:
+                self.open_connections -= 1
+            raise
+        self.pool.put(cnx)
+        self.logger.info("The data base '%s' exists, you are now connected.\n", self.DB_NAME)
+
+    # Creates a new connection with MySQL server, transient failures are retried with exponential backoff. With a
+    # timeout each attempt is bounded by the time left and no retry is made past it
+    #
+    def new_connection(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        for attempt in range(self.retries + 1):
+            config = dict(self.config)
+            if deadline is not None:
+                config['connection_timeout'] = max(1, int(math.ceil(deadline - time.time())))
             try:
-                self.cnx.database = self.DB_NAME
-            except mysql.connector.Error as err:
-                if err.errno == errorcode.ER_BAD_DB_ERROR:
-                    self.logger.error("Database '{}' does not exist, exiting now.\n".format(self.DB_NAME))
-                    sys.exit(1)
+                cnx = self.connector.connect(**config, auth_plugin='mysql_native_password')
+                # attempts to connect to named database
+                cnx.database = self.DB_NAME
+                return cnx
+            except mysql.connector.Error as e:
+                if e.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+                    self.logger.error("Something is wrong with your user name or password")
+                    raise
+                elif e.errno == errorcode.ER_BAD_DB_ERROR:
+                    self.logger.error("Database '%s' does not exist.\n", self.DB_NAME)
+                    raise
+                delay = self.backoff * 2 ** attempt
+                if attempt == self.retries or (deadline is not None and time.time() + delay >= deadline):
+                    self.logger.error(e)
+                    raise
+                self.logger.warning("MySQL connection attempt %s failed, retrying in %ss => %s", attempt + 1, delay, e)
+                time.sleep(delay)
+
+    # Checks out a validated connection for the duration of a with block. A new connection is opened while the pool
+    # is below its size, otherwise the caller waits for a connection to be returned. A connection that fails with a
+    # transient error is discarded rather than returned to the pool, after any other error it is returned as it is
+    # checked again on its next checkout
+    #
+    @contextmanager
+    def connection(self):
+        start = time.time()
+        with self.pool_lock:
+            create = self.pool.empty() and self.open_connections < self.pool_size
+            if create:
+                self.open_connections += 1
+        try:
+            if create:
+                cnx = self.new_connection()
             else:
-                self.logger.info("The data base '{}' exists, you are now connected.\n".format(self.DB_NAME))
+                cnx = self.pool.get(timeout=self.pool_timeout)
+                cnx = self.validate(cnx)
+        except (mysql.connector.Error, queue.Empty):
+            if create:
+                with self.pool_lock:
+                    self.open_connections -= 1
+            raise
 
-    # Get values from database, assemble into dictionary and return
+        wait = time.time() - start
+        with self.pool_lock:
+            self.pool_stats['checkouts'] += 1
+            self.pool_stats['wait_total'] += wait
+            self.pool_stats['wait_max'] = max(self.pool_stats['wait_max'], wait)
+
+        try:
+            yield cnx
+        except self.transient_errors:
+            self.discard(cnx)
+            cnx = None
+            raise
+        finally:
+            if cnx is not None:
+                self.pool.put(cnx)
+
+    # Pings a pooled connection before use, one that no longer answers is replaced
     #
-    def get_data(self, table_name, media_partner, advertiser):
-        # utilize a mysql cursor-dictionary class to return each db row as a dictionary, with column headings as keys
-        self.cursor = self.cnx.cursor(dictionary=True)
-        self.logger.info("Now using table {}".format(table_name))
-        # 2 different sql queries one for no brand -> 'IS NULL' and one for a brand value -> '= brand'
-        if media_partner is None:
-            query = "SELECT * FROM {} as t WHERE t.media_partner IS NULL AND t.account = '{}'".format(table_name,
-                                                                                                         advertiser)
-        else:
-            query = "SELECT * FROM {} as t WHERE t.media_partner = '{}' AND t.account = '{}'".format(table_name,
-                                                                                                        media_partner,
-                                                                                                        advertiser)
-        self.cursor.execute(query)
-        # this will return the only matched row in a dict structure
-        for row in self.cursor:
-            return row
+    def validate(self, cnx):
+        try:
+            cnx.ping(reconnect=False)
+            return cnx
+        except mysql.connector.Error as e:
+            self.logger.warning("Pooled MySQL connection failed its check, reconnecting => %s", e)
+            with self.pool_lock:
+                self.pool_stats['reconnects'] += 1
+            self.close_quietly(cnx)
+            try:
+                return self.new_connection()
+            except mysql.connector.Error:
+                with self.pool_lock:
+                    self.open_connections -= 1
+                raise
+
+    # Drops a broken connection from the pool
+    #
+    def discard(self, cnx):
+        self.close_quietly(cnx)
+        with self.pool_lock:
+            self.open_connections -= 1
+            self.pool_stats['reconnects'] += 1
+
+    # Runs a unit of database work with a pooled connection, retried with backoff on a new connection after a
+    # transient error
+    #
+    def run(self, work):
+        for attempt in range(self.retries + 1):
+            try:
+                metrics.count('mysql.query')
+                with metrics.span('mysql query'), self.connection() as cnx:
+                    return work(cnx)
+            except self.transient_errors as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning("MySQL query failed, retrying in %ss => %s", delay, e)
+                time.sleep(delay)
+
+    # Read the whole assignments table once with a single streamed (unbuffered) query and index the rows on
+    # (account, media partner), first row wins. The indexed rows are hashed so that a change to the table can be told
+    # from one run to the next
+    #
+    def load_assignments(self, table_name):
+        self.assignments = self.run(lambda cnx: self.query_assignments(cnx, table_name))
+        self.assignments_fingerprint = self.rows_fingerprint(self.assignments.values())
+        self.logger.info("Loaded %s assignment rows from table %s", len(self.assignments), table_name)
+
+    # Runs the query for load_assignments on the given connection
+    #
+    def query_assignments(self, cnx, table_name):
+        assignments = dict()
+        cursor = cnx.cursor(dictionary=True, buffered=False)
+        try:
+            cursor.execute("SELECT * FROM {}".format(self.table_identifier(table_name)))
+            for row in cursor:
+                assignments.setdefault(self.assignment_key(row.get('account'), row.get('media_partner')), row)
+        finally:
+            cursor.close()
+        return assignments
+
+    # Hash of a set of rows, independent of the row order
+    #
+    @staticmethod
+    def rows_fingerprint(rows):
+        digest = hashlib.sha1()
+        for line in sorted(json.dumps(row, sort_keys=True, default=str) for row in rows):
+            digest.update(line.encode('utf-8'))
+        return digest.hexdigest()
+
+    # Return a copy of the indexed assignment row for an account and media partner, or None
+    #
+    def assignment_lookup(self, account, media_partner):
+        row = self.assignments.get(self.assignment_key(account, media_partner))
+        return dict(row) if row is not None else None
+
+    # Index key for an assignment row, values are compared as trimmed strings so that a numeric pid matches either a
+    # numeric or a text 'account' column
+    #
+    @staticmethod
+    def assignment_key(account, media_partner):
+        return (str(account).strip() if account is not None else None,
+                str(media_partner).strip() if media_partner is not None else None)
+
+    # Quote a table name for use in a query, table names cannot be sent as query parameters
+    #
+    @staticmethod
+    def table_identifier(table_name):
+        if not re.match(r'^\w+$', table_name):
+            raise ValueError("Invalid table name '{}'".format(table_name))
+        return '`{}`'.format(table_name)
 
     # Normalize data before database insertion, attend to and/or escape apostrophes and capture 'None's
     #
@@ -69,9 +233,30 @@ class MySQLManager(object):
         else:
             return s
 
-    # Closes cursor and connection
+    # Returns the pool checkout count and wait times
+    #
+    def stats(self):
+        with self.pool_lock:
+            stats = dict(self.pool_stats)
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        stats['open_connections'] = self.open_connections
+        return stats
+
+    @staticmethod
+    def close_quietly(cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    # Closes every pooled connection
     #
     def close_connection(self):
-        self.cursor.close()
-        self.cnx.close()
+        stats = self.stats()
+        while not self.pool.empty():
+            self.close_quietly(self.pool.get_nowait())
+        with self.pool_lock:
+            self.open_connections = 0
+        self.logger.info("MySQL pool: %s checkouts, %.3fs average wait, %.3fs longest wait, %s reconnects",
+                         stats['checkouts'], stats['wait_avg'], stats['wait_max'], stats['reconnects'])
         self.logger.info("Now closing mysql connection.")
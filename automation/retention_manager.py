@@ -0,0 +1,126 @@
+# retention_manager module
+# Module holds the class => RetentionManager - manages the retention of the files in the log directory
+# Class responsible for the log directory sweep, a single scandir pass over the directory in which the log, journal
+# and run metrics files are gzip compressed once older than compress_days and removed once older than retention_days.
+# The age of a file is taken from its modification time, which is carried over to its compressed copy. A journal is
+# only compressed once its run is complete, an incomplete journal is kept as is for a later --resume. The sweep may
+# be run in a background thread so that it does not lengthen the run.
+#
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+from journal_manager import JournalManager
+
+
+class RetentionManager(object):
+    def __init__(self, directory, retention_days, compress_days=0):
+        self.directory = directory
+        self.retention_days = float(retention_days)
+        self.compress_days = float(compress_days)       # 0 turns compression off
+        self.extensions = ('.log', '.journal')
+        self.suffixes = ('_metrics.json',)
+        self.sweeper = None
+        self.stats = dict()
+        self.logger = logging.getLogger(__name__)
+
+    # Checks whether a file is kept by the retention rules, compressed copies and their temporary files included
+    #
+    def retained(self, file_name):
+        if file_name.endswith('.gz.tmp'):
+            file_name = file_name[:-7]
+        elif file_name.endswith('.gz'):
+            file_name = file_name[:-3]
+        return file_name.endswith(self.extensions) or file_name.endswith(self.suffixes)
+
+    # Checks whether a file may be compressed, the journal of an incomplete run is left for --resume to find
+    #
+    @staticmethod
+    def compressible(file_name):
+        if file_name.endswith('.gz'):
+            return False
+        if file_name.endswith('.journal'):
+            return JournalManager.journal_complete(file_name)
+        return True
+
+    # Sweeps the directory once, compressing and removing files by age, returns the counts
+    #
+    def sweep(self):
+        self.stats = {"scanned": 0, "compressed": 0, "removed": 0, "errors": 0}
+        start = time.time()
+        remove_before = start - self.retention_days * 86400
+        compress_before = start - self.compress_days * 86400 if self.compress_days > 0 else None
+        self.logger.info("")
+        if compress_before is not None:
+            self.logger.info("Remove %g days old files from the %s directory, compress %g days old files",
+                             self.retention_days, self.directory, self.compress_days)
+        else:
+            self.logger.info("Remove %g days old files from the %s directory", self.retention_days, self.directory)
+        try:
+            with os.scandir(self.directory) as entries:
+                entries = [entry for entry in entries
+                           if self.retained(entry.name) and entry.is_file(follow_symlinks=False)]
+            # the temporary files left by a background sweep killed mid copy go first, their original files are still
+            # in place and are compressed again by this sweep
+            entries.sort(key=lambda entry: not entry.name.endswith('.gz.tmp'))
+            for entry in entries:
+                self.stats['scanned'] += 1
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                    if entry.name.endswith('.gz.tmp'):
+                        self.logger.info("Removing the partly compressed file [%s]", entry.path)
+                        os.remove(entry.path)
+                        self.stats['removed'] += 1
+                    elif mtime < remove_before:
+                        self.logger.info("Removing File [%s] with timestamp [%s]", entry.path,
+                                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)))
+                        os.remove(entry.path)
+                        self.stats['removed'] += 1
+                    elif compress_before is not None and mtime < compress_before and self.compressible(entry.path):
+                        self.compress(entry.path, mtime)
+                        self.stats['compressed'] += 1
+                except OSError as e:
+                    self.logger.warning("Retention failed for file %s => %s", entry.path, e)
+                    self.stats['errors'] += 1
+        except OSError as e:
+            self.logger.error("Retention sweep of %s failed => %s", self.directory, e)
+            self.stats['errors'] += 1
+        self.logger.info("Retention sweep: %s file(s) checked, %s compressed, %s removed, %s error(s) in %.3fs",
+                         self.stats['scanned'], self.stats['compressed'], self.stats['removed'], self.stats['errors'],
+                         time.time() - start)
+        return self.stats
+
+    # Replaces a file with its gzip compressed copy, written to a temporary file first then swapped into place. The
+    # copy keeps the modification time of the original so that it is removed on the same day
+    #
+    def compress(self, file_name, mtime):
+        gz_file_name = '{}.gz'.format(file_name)
+        temp_file_name = '{}.tmp'.format(gz_file_name)
+        try:
+            with open(file_name, 'rb') as source, gzip.open(temp_file_name, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.utime(temp_file_name, (mtime, mtime))
+            os.replace(temp_file_name, gz_file_name)
+        except OSError:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+        os.remove(file_name)
+
+    # Runs the sweep in a background thread
+    #
+    def start(self):
+        self.sweeper = threading.Thread(target=self.sweep, name='RetentionSweep', daemon=True)
+        self.sweeper.start()
+
+    def is_running(self):
+        return self.sweeper is not None and self.sweeper.is_alive()
+
+    # Waits for a background sweep to finish
+    #
+    def wait(self, timeout=None):
+        if self.sweeper is not None:
+            self.sweeper.join(timeout)
@@ -0,0 +1,123 @@
+# test_api_manager module
+# Unit tests for APICallManager -> the status handling of api_call, the circuit breaker and the batch resolution,
+# against the benchmark's local Study Builder stand-in
+#
+import logging
+import os
+import sys
+import unittest
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+sys.path.insert(0, os.path.join(AUTOMATION_DIR, 'benchmark'))
+
+from api_manager import APICallManager, StudyBuilderUnavailable
+from fake_services import FakeStudyBuilderService
+
+
+# The log messages of the failures under test are not shown
+#
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class APICallTest(unittest.TestCase):
+    def setUp(self):
+        self.services = list()
+
+    def tearDown(self):
+        for service in self.services:
+            service.stop()
+
+    def study_builder(self, error_rate=0.0, error_status=500):
+        service = FakeStudyBuilderService({101: 9001}, error_rate=error_rate, error_status=error_status).start()
+        self.services.append(service)
+        return service
+
+    @staticmethod
+    def api(retries=2, min_calls=10):
+        api = APICallManager(concurrency=4, connect_timeout=2, read_timeout=2, retries=retries, backoff=0.01,
+                             min_calls=min_calls, window=min_calls)
+        api.max_retry_after = 0.01
+        return api
+
+    def test_found_study(self):
+        service = self.study_builder()
+        status, call_dict = self.api().api_call(service.study_url, 101)
+        self.assertEqual(status, 200)
+        self.assertEqual(APICallManager.parent_id_fetch(call_dict), 9001)
+
+    def test_unknown_study_is_an_answer(self):
+        service = self.study_builder()
+        api = self.api()
+        self.assertEqual(api.api_call(service.study_url, 102), (404, None))
+        self.assertEqual(api.breaker_stats()['failures'], 0)
+
+    def test_refused_call_is_a_failure_without_retry(self):
+        for error_status in (401, 403):
+            service = self.study_builder(error_rate=1.0, error_status=error_status)
+            api = self.api()
+            self.assertEqual(api.api_call(service.study_url, 101), (None, None))
+            self.assertEqual(service.faults.stats()['requests']['study'], 1)
+            self.assertEqual(api.breaker_stats()['failures'], 1)
+
+    def test_rate_limited_call_is_retried(self):
+        service = self.study_builder(error_rate=1.0, error_status=429)
+        api = self.api(retries=2)
+        self.assertEqual(api.api_call(service.study_url, 101), (None, None))
+        self.assertEqual(service.faults.stats()['requests']['study'], 3)
+        self.assertEqual(api.breaker_stats()['failures'], 3)
+
+    def test_server_error_is_retried(self):
+        service = self.study_builder(error_rate=1.0, error_status=503)
+        api = self.api(retries=1)
+        self.assertEqual(api.api_call(service.study_url, 101), (None, None))
+        self.assertEqual(service.faults.stats()['requests']['study'], 2)
+
+    def test_breaker_opens_on_the_error_rate(self):
+        service = self.study_builder(error_rate=1.0, error_status=500)
+        api = self.api(retries=0, min_calls=4)
+        for _ in range(3):
+            self.assertEqual(api.api_call(service.study_url, 101), (None, None))
+        self.assertFalse(api.breaker_stats()['breaker_open'])
+        # the fourth failure crosses the error rate, the call itself then reports the open breaker
+        self.assertRaises(StudyBuilderUnavailable, api.api_call, service.study_url, 101)
+        self.assertRaises(StudyBuilderUnavailable, api.api_call, service.study_url, 101)
+        stats = api.breaker_stats()
+        self.assertTrue(stats['breaker_open'])
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(service.faults.stats()['requests']['study'], 4)
+
+    def test_breaker_stays_closed_below_the_error_rate(self):
+        service = self.study_builder()
+        api = self.api(retries=0, min_calls=4)
+        for _ in range(8):
+            api.api_call(service.study_url, 102)
+        self.assertFalse(api.breaker_stats()['breaker_open'])
+
+    def test_reset_closes_the_breaker(self):
+        service = self.study_builder(error_rate=1.0)
+        api = self.api(retries=0, min_calls=2)
+        for _ in range(2):
+            try:
+                api.api_call(service.study_url, 101)
+            except StudyBuilderUnavailable:
+                pass
+        self.assertTrue(api.breaker_stats()['breaker_open'])
+        api.reset_breaker()
+        self.assertEqual(api.breaker_stats(), {"calls": 0, "failures": 0, "rejected": 0, "breaker_open": False})
+
+    def test_batch_leaves_out_failed_calls(self):
+        service = self.study_builder()
+        self.assertEqual(self.api().parent_id_batch(service.study_url, [101, 102]), {101: 9001, 102: None})
+        service = self.study_builder(error_rate=1.0, error_status=401)
+        self.assertEqual(self.api().parent_id_batch(service.study_url, [101, 102]), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# test_mysql_manager module
+# Unit tests for the MySQLManager connection pool -> checkout, return and discard of pooled connections, against the
+# benchmark's sqlite backed MySQL stand-in
+#
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import unittest
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+sys.path.insert(0, os.path.join(AUTOMATION_DIR, 'benchmark'))
+
+import mysql.connector
+
+from fake_services import FakeMySQLConnector
+from mysql_manager import MySQLManager
+
+
+# The log messages of the failures under test are not shown
+#
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.connector = FakeMySQLConnector(os.path.join(self.directory, 'assignments.db'))
+        self.connector.load_table('assignments', [{"account": 1, "media_partner": None, "reporter": 'a.user'}])
+        self.db = MySQLManager(dict(), 'db', pool_size=2, retries=0, backoff=0, pool_timeout=0.2,
+                               connector=self.connector)
+
+    def tearDown(self):
+        self.db.close_connection()
+        shutil.rmtree(self.directory)
+
+    def checkout_and_raise(self, error):
+        try:
+            with self.db.connection():
+                raise error
+        except type(error):
+            pass
+
+    def test_connection_is_reused(self):
+        with self.db.connection() as first:
+            pass
+        with self.db.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(self.db.stats()['open_connections'], 1)
+
+    def test_connection_is_returned_after_a_non_transient_error(self):
+        for _ in range(3):
+            self.checkout_and_raise(ValueError('not a database error'))
+        with self.db.connection():
+            pass
+        stats = self.db.stats()
+        self.assertEqual(stats['checkouts'], 4)
+        self.assertEqual(stats['open_connections'], 1)
+        self.assertEqual(self.db.pool.qsize(), 1)
+
+    def test_connection_is_discarded_after_a_transient_error(self):
+        self.checkout_and_raise(mysql.connector.errors.OperationalError(msg='Lost connection', errno=2013))
+        stats = self.db.stats()
+        self.assertEqual(stats['open_connections'], 0)
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(self.db.pool.qsize(), 0)
+        with self.db.connection():
+            pass
+        self.assertEqual(self.db.stats()['open_connections'], 1)
+
+    def test_checkout_waits_for_a_connection_when_the_pool_is_full(self):
+        with self.db.connection(), self.db.connection():
+            self.assertEqual(self.db.stats()['open_connections'], 2)
+            with self.assertRaises(queue.Empty):
+                with self.db.connection():
+                    pass
+        self.assertEqual(self.db.pool.qsize(), 2)
+
+    def test_run_retries_on_a_new_connection(self):
+        self.db.retries = 1
+        attempts = list()
+
+        def work(cnx):
+            attempts.append(cnx)
+            if len(attempts) == 1:
+                raise mysql.connector.errors.InterfaceError(msg='Connection dropped', errno=2013)
+            return 'done'
+
+        self.assertEqual(self.db.run(work), 'done')
+        self.assertIsNot(attempts[0], attempts[1])
+        self.assertEqual(self.db.stats()['open_connections'], 1)
+
+    def test_assignments_fingerprint_follows_the_table(self):
+        self.db.load_assignments('assignments')
+        fingerprint = self.db.assignments_fingerprint
+        self.db.load_assignments('assignments')
+        self.assertEqual(self.db.assignments_fingerprint, fingerprint)
+        self.connector.load_table('assignments', [{"account": 1, "media_partner": None, "reporter": 'b.user'}])
+        self.db.load_assignments('assignments')
+        self.assertNotEqual(self.db.assignments_fingerprint, fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# test_retention_manager module
+# Unit tests for RetentionManager -> the compression and removal of old files in the log directory, and the journals
+# that a later --resume must still find
+#
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+
+from journal_manager import JournalManager
+from retention_manager import RetentionManager
+
+
+# The log messages of the sweep are not shown
+#
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Writes a file aged by the given number of days
+    #
+    def old_file(self, file_name, days, lines=('line',)):
+        path = os.path.join(self.directory, file_name)
+        with open(path, 'w') as old_file:
+            for line in lines:
+                old_file.write(line + '\n')
+        mtime = time.time() - days * 86400
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def journal(self, file_name, days, complete):
+        lines = [json.dumps({"ticket": 'CPG-1', "stage": 'resolved', "data": 101})]
+        if complete:
+            lines.append(json.dumps({"stage": 'complete'}))
+        return self.old_file(file_name, days, lines)
+
+    def sweep(self):
+        return RetentionManager(self.directory + os.sep, retention_days=30, compress_days=7).sweep()
+
+    def test_old_files_are_compressed_then_removed(self):
+        self.old_file('app_1.log', 10)
+        self.old_file('app_2_metrics.json', 10)
+        self.old_file('app_3.log', 40)
+        self.old_file('notes.txt', 40)
+        stats = self.sweep()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['app_1.log.gz', 'app_2_metrics.json.gz', 'notes.txt'])
+        self.assertEqual((stats['compressed'], stats['removed']), (2, 1))
+
+    def test_only_complete_journals_are_compressed(self):
+        self.journal('app_1.journal', 10, complete=True)
+        self.journal('app_2.journal', 10, complete=False)
+        self.sweep()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['app_1.journal.gz', 'app_2.journal'])
+
+    def test_incomplete_journal_is_resumed_after_the_sweep(self):
+        self.journal('app_1.journal', 12, complete=False)
+        self.sweep()
+        journal = JournalManager(self.directory + os.sep, 'app')
+        journal.open_journal(resume=True)
+        self.assertTrue(journal.completed('CPG-1', 'resolved'))
+
+    def test_compressed_latest_journal_is_not_resumed(self):
+        self.journal('app_1.journal', 20, complete=False)
+        self.journal('app_2.journal', 10, complete=True)
+        self.sweep()
+        journal = JournalManager(self.directory + os.sep, 'app')
+        self.assertIsNone(journal.latest_journal())
+
+    def test_partly_compressed_files_are_removed(self):
+        self.old_file('app_1.log', 10)
+        self.old_file('app_1.log.gz.tmp', 0)
+        stats = self.sweep()
+        self.assertEqual(os.listdir(self.directory), ['app_1.log.gz'])
+        self.assertEqual(stats['removed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
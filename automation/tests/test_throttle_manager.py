@@ -0,0 +1,196 @@
+# test_throttle_manager module
+# Unit tests for ThrottleManager -> the token bucket, the AIMD concurrency limit and the Retry-After handling of call,
+# and for the module function retry_after
+#
+from email.utils import formatdate
+import logging
+import os
+import sys
+import time
+import unittest
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+
+from throttle_manager import ThrottleManager, retry_after
+
+
+# The log messages of the failures under test are not shown
+#
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+# Stand-ins for a requests response and the JIRAError raised for a throttled request
+#
+class FakeResponse(object):
+    def __init__(self, headers=None):
+        self.headers = headers or dict()
+
+
+class FakeThrottled(Exception):
+    def __init__(self, status_code, retry_after_value=None):
+        Exception.__init__(self, status_code)
+        self.status_code = status_code
+        self.response = FakeResponse({'Retry-After': retry_after_value} if retry_after_value is not None else None)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_is_not_paced(self):
+        throttle = ThrottleManager(rate=1, burst=5)
+        start = time.monotonic()
+        for _ in range(5):
+            throttle.take_token()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_requests_past_the_burst_are_paced_at_the_rate(self):
+        throttle = ThrottleManager(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            throttle.take_token()
+        # the first token is in the bucket, the next five are refilled at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertGreater(throttle.stats['token_wait_total'], 0.0)
+
+    def test_zero_rate_turns_pacing_off(self):
+        throttle = ThrottleManager(rate=0, burst=1)
+        start = time.monotonic()
+        for _ in range(100):
+            throttle.take_token()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class ConcurrencyLimitTest(unittest.TestCase):
+    def test_throttled_request_halves_the_limit_once_per_second(self):
+        throttle = ThrottleManager(max_concurrency=8)
+        for _ in range(2):
+            throttle.acquire_slot()
+        throttle.release_slot(throttled=True)
+        self.assertEqual(int(throttle.limit), 4)
+        # a burst of rejections counts as a single decrease
+        throttle.release_slot(throttled=True)
+        self.assertEqual(int(throttle.limit), 4)
+        self.assertEqual(throttle.stats['decreases'], 1)
+        self.assertEqual(throttle.stats['throttled'], 2)
+
+    def test_limit_does_not_drop_below_the_minimum(self):
+        throttle = ThrottleManager(max_concurrency=8, min_concurrency=3)
+        throttle.acquire_slot()
+        throttle.release_slot(throttled=True)
+        throttle.decreased = 0.0
+        throttle.acquire_slot()
+        throttle.release_slot(throttled=True)
+        self.assertEqual(throttle.limit, 3.0)
+
+    def test_successes_grow_the_limit_by_one_per_limit_requests(self):
+        throttle = ThrottleManager(max_concurrency=8)
+        throttle.limit = 4.0
+        for _ in range(4):
+            throttle.acquire_slot()
+            throttle.release_slot()
+        self.assertEqual(int(throttle.limit), 4)
+        throttle.acquire_slot()
+        throttle.release_slot()
+        self.assertEqual(int(throttle.limit), 5)
+
+    def test_limit_does_not_grow_past_the_maximum(self):
+        throttle = ThrottleManager(max_concurrency=2)
+        for _ in range(10):
+            throttle.acquire_slot()
+            throttle.release_slot()
+        self.assertEqual(throttle.limit, 2.0)
+        self.assertEqual(throttle.in_flight, 0)
+
+
+class RetryTest(unittest.TestCase):
+    def test_throttled_request_is_retried_after_retry_after(self):
+        throttle = ThrottleManager(rate=0, retries=2)
+        answers = [FakeThrottled(429, '0'), 'done']
+
+        def request():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.assertEqual(throttle.call(request), 'done')
+        self.assertEqual(throttle.stats['retries'], 1)
+        self.assertEqual(throttle.stats['throttled'], 1)
+        self.assertEqual(throttle.in_flight, 0)
+
+    def test_other_errors_are_raised_without_retry(self):
+        throttle = ThrottleManager(rate=0, retries=2)
+        calls = list()
+
+        def request():
+            calls.append(1)
+            raise FakeThrottled(500)
+
+        self.assertRaises(FakeThrottled, throttle.call, request)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(throttle.in_flight, 0)
+
+    def test_request_that_is_not_idempotent_is_retried_only_on_429(self):
+        throttle = ThrottleManager(rate=0, retries=2)
+        answers = [FakeThrottled(429, '0'), FakeThrottled(503, '0'), 'done']
+
+        def request():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.assertRaises(FakeThrottled, throttle.call, request, idempotent=False)
+        self.assertEqual(answers, ['done'])
+        self.assertEqual(throttle.stats['retries'], 1)
+        self.assertEqual(throttle.stats['throttled'], 2)
+        self.assertEqual(throttle.in_flight, 0)
+
+    def test_still_throttled_after_the_retries_raises(self):
+        throttle = ThrottleManager(rate=0, retries=1)
+
+        def request():
+            raise FakeThrottled(503, '0')
+
+        self.assertRaises(FakeThrottled, throttle.call, request)
+        self.assertEqual(throttle.stats['retries'], 1)
+
+    def test_retry_delay_is_capped_by_max_backoff(self):
+        throttle = ThrottleManager(max_backoff=5)
+        self.assertEqual(throttle.retry_delay(FakeThrottled(429, '120'), 0), 5)
+
+    def test_retry_delay_without_retry_after_is_a_jittered_backoff(self):
+        throttle = ThrottleManager(backoff=1, max_backoff=60)
+        for attempt in range(4):
+            delay = throttle.retry_delay(FakeThrottled(429), attempt)
+            self.assertGreaterEqual(delay, 0.0)
+            self.assertLessEqual(delay, 2 ** attempt)
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry_after(FakeResponse({'Retry-After': '7'})), 7.0)
+
+    def test_negative_seconds_wait_no_time(self):
+        self.assertEqual(retry_after(FakeResponse({'Retry-After': '-3'})), 0.0)
+
+    def test_http_date(self):
+        delay = retry_after(FakeResponse({'Retry-After': formatdate(time.time() + 30, usegmt=True)}))
+        self.assertGreater(delay, 25)
+        self.assertLessEqual(delay, 30)
+
+    def test_past_http_date_waits_no_time(self):
+        self.assertEqual(retry_after(FakeResponse({'Retry-After': formatdate(time.time() - 30, usegmt=True)})), 0.0)
+
+    def test_unusable_header(self):
+        self.assertIsNone(retry_after(FakeResponse({'Retry-After': 'soon'})))
+        self.assertIsNone(retry_after(FakeResponse()))
+        self.assertIsNone(retry_after(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
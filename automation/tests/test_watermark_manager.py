@@ -0,0 +1,127 @@
+# test_watermark_manager module
+# Unit tests for WatermarkManager -> the incremental search window, the full sweep triggers, the handled tickets and
+# the pending tickets left unfinished by a run
+#
+from datetime import timedelta
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AUTOMATION_DIR)
+
+from watermark_manager import WatermarkManager
+
+
+# The log messages of the failures under test are not shown
+#
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class WatermarkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'watermark.json')
+        self.run_start = WatermarkManager.now() - timedelta(hours=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # A watermark saved by a first full sweep, then read back as by the next run
+    #
+    def saved(self, handled=None, unfinished_keys=(), source='source', enabled=True):
+        watermark = WatermarkManager(self.path, enabled, full_sweep_days=7, overlap_minutes=30)
+        watermark.load()
+        watermark.save(self.run_start, True, source, handled or dict(), list(unfinished_keys))
+        watermark = WatermarkManager(self.path, enabled, full_sweep_days=7, overlap_minutes=30)
+        watermark.load()
+        return watermark
+
+    def jira_time(self, value):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.000%z')
+
+    def test_first_run_is_a_full_sweep(self):
+        watermark = WatermarkManager(self.path)
+        watermark.load()
+        self.assertIsNone(watermark.search_window('source', WatermarkManager.now()))
+
+    def test_window_covers_the_time_since_the_last_run_and_the_overlap(self):
+        watermark = self.saved()
+        now = self.run_start + timedelta(minutes=60)
+        self.assertEqual(watermark.search_window('source', now), 90)
+
+    def test_changed_data_source_is_a_full_sweep(self):
+        watermark = self.saved(source=['file.xlsx', 100, 1.0])
+        self.assertIsNone(watermark.search_window(['file.xlsx', 200, 2.0], self.run_start + timedelta(minutes=5)))
+
+    def test_old_full_sweep_is_a_full_sweep(self):
+        watermark = self.saved()
+        self.assertIsNone(watermark.search_window('source', self.run_start + timedelta(days=7)))
+
+    def test_disabled_watermark_is_a_full_sweep(self):
+        watermark = self.saved(enabled=False)
+        self.assertIsNone(watermark.search_window('source', self.run_start + timedelta(minutes=5)))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unfinished_tickets_are_pending(self):
+        handled_at = self.run_start + timedelta(minutes=5)
+        watermark = self.saved({'CPG-1': handled_at}, ['CPG-2', 'CPG-3', 'CPG-2'])
+        self.assertEqual(watermark.pending, ['CPG-2', 'CPG-3'])
+        self.assertEqual(list(watermark.handled), ['CPG-1'])
+        self.assertIsNotNone(watermark.search_window('source', self.run_start + timedelta(minutes=10)))
+
+    def test_unfinished_ticket_is_no_longer_handled(self):
+        handled_at = self.run_start + timedelta(minutes=5)
+        watermark = self.saved({'CPG-1': handled_at})
+        watermark.save(self.run_start + timedelta(minutes=10), False, 'source', dict(), ['CPG-1'])
+        watermark.load()
+        self.assertEqual(watermark.handled, dict())
+        self.assertEqual(watermark.pending, ['CPG-1'])
+
+    def test_too_many_pending_tickets_is_a_full_sweep(self):
+        watermark = self.saved(unfinished_keys=['CPG-{}'.format(n) for n in range(101)])
+        self.assertIsNone(watermark.search_window('source', self.run_start + timedelta(minutes=5)))
+
+    def test_handled_ticket_is_skipped_until_updated_again(self):
+        handled_at = self.run_start + timedelta(minutes=5)
+        watermark = self.saved({'CPG-1': handled_at})
+        # the automation's own update, within the allowed clock skew of the handled time
+        self.assertTrue(watermark.is_handled('CPG-1', self.jira_time(handled_at + timedelta(minutes=1))))
+        self.assertFalse(watermark.is_handled('CPG-1', self.jira_time(handled_at + timedelta(minutes=10))))
+        self.assertFalse(watermark.is_handled('CPG-2', self.jira_time(handled_at)))
+        self.assertFalse(watermark.is_handled('CPG-1', None))
+        self.assertFalse(watermark.is_handled('CPG-1', 'not a time'))
+
+    def test_each_ticket_keeps_its_own_handled_time(self):
+        early = self.run_start + timedelta(minutes=1)
+        late = self.run_start + timedelta(minutes=30)
+        watermark = self.saved({'CPG-1': early, 'CPG-2': late})
+        # a change made to the first ticket while the run was still going is not taken for the automation's own
+        self.assertFalse(watermark.is_handled('CPG-1', self.jira_time(early + timedelta(minutes=20))))
+        self.assertTrue(watermark.is_handled('CPG-2', self.jira_time(late)))
+
+    def test_handled_tickets_outside_the_overlap_are_dropped(self):
+        watermark = self.saved({'CPG-1': self.run_start + timedelta(minutes=5)})
+        watermark.save(self.run_start + timedelta(hours=2), False, 'source', {'CPG-2': self.run_start}, [])
+        watermark.load()
+        self.assertEqual(list(watermark.handled), ['CPG-2'])
+
+    def test_unreadable_watermark_is_a_full_sweep(self):
+        with open(self.path, 'w') as watermark_file:
+            watermark_file.write('{"last_run": ')
+        watermark = WatermarkManager(self.path)
+        watermark.load()
+        self.assertIsNone(watermark.search_window('source', WatermarkManager.now()))
+        self.assertEqual(watermark.pending, list())
+
+
+if __name__ == '__main__':
+    unittest.main()
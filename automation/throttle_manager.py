@@ -0,0 +1,177 @@
+# throttle_manager module
+# Module holds the class => ThrottleManager - paces the requests made to the Jira server
+# Class responsible for the Jira request throttling, every request of JiraManager is passed through call, which takes
+# a token from a token bucket refilled at the configured request rate and a slot under an adaptive concurrency limit.
+# The limit grows by one for each limit's worth of successful requests and is halved when the server answers 429 or
+# 503 (additive increase, multiplicative decrease), the rejected request is retried after the Retry-After time given
+# by the server, or an exponential backoff with jitter. A request that is not idempotent, e.g. a transition POST, is
+# only retried on 429, a 503 from a proxy may arrive after Jira applied it. Throttle events are counted in the run
+# metrics.
+# The Retry-After header is read by the module function retry_after, which the Study Builder client shares.
+#
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+
+from metrics_manager import metrics
+
+
+# Returns the seconds to wait given by the Retry-After header of an http response, as a number of seconds or an http
+# date, or None when the response has no usable header
+#
+def retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class ThrottleManager(object):
+    def __init__(self, rate=20, burst=10, max_concurrency=8, min_concurrency=1, retries=5, backoff=1, max_backoff=60):
+        self.rate = float(rate)                 # requests per second, 0 for no rate limit
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.throttle_statuses = (429, 503)
+        self.rejected_statuses = (429,)         # answered before the request was applied, safe to retry any request
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+        self.bucket_lock = threading.Lock()
+        self.stats = dict()
+        self.reset_stats()
+        self.logger = logging.getLogger(__name__)
+
+    # Makes a Jira request within the rate and concurrency limits, a throttled request is retried after a wait. A
+    # request that is not idempotent is only retried when it was rejected with 429
+    #
+    def call(self, request, *args, idempotent=True, **kwargs):
+        retry_statuses = self.throttle_statuses if idempotent else self.rejected_statuses
+        for attempt in range(self.retries + 1):
+            self.take_token()
+            self.acquire_slot()
+            try:
+                result = request(*args, **kwargs)
+            except Exception as e:
+                status_code = getattr(e, 'status_code', None)
+                if status_code not in self.throttle_statuses:
+                    self.release_slot()
+                    raise
+                self.release_slot(throttled=True)
+                if status_code not in retry_statuses:
+                    self.logger.warning("Jira request throttled (%s), not retried as it may have been applied",
+                                        status_code)
+                    raise
+                if attempt == self.retries:
+                    self.logger.warning("Jira request still throttled after %s retries => %s", self.retries,
+                                        status_code)
+                    raise
+                delay = self.retry_delay(e, attempt)
+                self.logger.info("Jira request throttled (%s), retry %s in %.1fs, concurrency limit %s",
+                                 status_code, attempt + 1, delay, int(self.limit))
+                with self.condition:
+                    self.stats['retries'] += 1
+                    self.stats['backoff_total'] += delay
+                metrics.count('jira.retry')
+                time.sleep(delay)
+            else:
+                self.release_slot()
+                return result
+
+    # Waits for a token from the bucket, which is refilled continuously at the request rate up to the burst size
+    #
+    def take_token(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.bucket_lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            with self.condition:
+                self.stats['token_wait_total'] += wait
+            time.sleep(wait)
+
+    # Waits until fewer requests are in flight than the current concurrency limit
+    #
+    def acquire_slot(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.stats['in_flight_max'] = max(self.stats['in_flight_max'], self.in_flight)
+
+    # Frees a slot and adjusts the concurrency limit, halved on a throttled request, at most once per second so that a
+    # burst of rejections counts as one, otherwise raised by 1 / limit
+    #
+    def release_slot(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.stats['throttled'] += 1
+                now = time.monotonic()
+                if now - self.decreased >= 1.0:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self.decreased = now
+                    self.stats['decreases'] += 1
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.stats['limit_min'] = min(self.stats['limit_min'], int(self.limit))
+            self.condition.notify_all()
+        if throttled:
+            metrics.count('jira.throttled')
+
+    # Returns the seconds to wait before a retry, the server's Retry-After (seconds or a date) when given, otherwise
+    # an exponential backoff with full jitter
+    #
+    def retry_delay(self, e, attempt):
+        delay = retry_after(getattr(e, 'response', None))
+        if delay is not None:
+            return min(self.max_backoff, delay)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def reset_stats(self):
+        with self.condition:
+            self.stats = {
+                "throttled":        0,
+                "retries":          0,
+                "decreases":        0,
+                "backoff_total":    0.0,
+                "token_wait_total": 0.0,
+                "in_flight_max":    0,
+                "limit_min":        int(self.limit)
+            }
+
+    # Logs the throttle events of the run and returns them with the current concurrency limit, then starts the counts
+    # over
+    #
+    def log_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['limit'] = int(self.limit)
+        self.reset_stats()
+        stats['backoff_total'] = round(stats['backoff_total'], 3)
+        stats['token_wait_total'] = round(stats['token_wait_total'], 3)
+        if stats['throttled'] > 0:
+            self.logger.info("Jira throttling: %s throttled request(s), %s retries, %.1fs backoff, concurrency limit "
+                             "%s (lowest %s)", stats['throttled'], stats['retries'], stats['backoff_total'],
+                             stats['limit'], stats['limit_min'])
+        return stats
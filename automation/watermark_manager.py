@@ -0,0 +1,127 @@
+# watermark_manager module
+# Module holds the class => WatermarkManager - manages the incremental ticket search high-water mark
+# Class responsible for the watermark file kept next to the logs, which records the start time of the last complete
+# run, the time of the last full sweep, the tickets the last run handled and the tickets it left unfinished. The next
+# run then only searches tickets updated since the watermark along with the unfinished (pending) tickets, and skips the
+# handled tickets whose only update was the automation's own. A full sweep is made when none has been made for the
+# configured number of days, when the ticket data source has changed or when too many tickets are pending.
+#
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import math
+import os
+
+
+class WatermarkManager(object):
+    def __init__(self, path, enabled=True, full_sweep_days=7, overlap_minutes=30):
+        self.path = path
+        self.enabled = enabled
+        self.full_sweep = timedelta(days=float(full_sweep_days))
+        self.overlap = timedelta(minutes=float(overlap_minutes))
+        self.clock_skew = timedelta(minutes=2)  # allowed difference between this host's clock and the Jira server's
+        self.time_format = '%Y-%m-%dT%H:%M:%S.%f%z'
+        self.max_pending = 100                  # pending tickets searched by key, beyond this a full sweep is made
+        self.state = dict()
+        self.handled = dict()
+        self.pending = list()
+        self.logger = logging.getLogger(__name__)
+
+    # Reads the watermark file, a missing or unreadable file leaves no watermark and the next search is a full sweep
+    #
+    def load(self):
+        self.state = dict()
+        self.handled = dict()
+        self.pending = list()
+        if not self.enabled or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as watermark_file:
+                self.state = json.load(watermark_file)
+            self.handled = dict((key, self.parse_time(handled_at))
+                                for key, handled_at in self.state.get('handled', dict()).items())
+            self.pending = list(self.state.get('pending', list()))
+        except Exception as e:
+            self.logger.warning("Unreadable watermark %s, making a full sweep => %s", self.path, e)
+            self.state = dict()
+            self.handled = dict()
+            self.pending = list()
+
+    # Returns the search window in minutes for an incremental search, or None when a full sweep is due
+    #
+    def search_window(self, source, now):
+        if not self.enabled or 'last_run' not in self.state:
+            return None
+        if source != self.state.get('source'):
+            self.logger.info("Ticket data source has changed since the last run, making a full sweep")
+            return None
+        if now - self.parse_time(self.state['last_full_sweep']) >= self.full_sweep:
+            self.logger.info("Last full sweep is older than %s, making a full sweep", self.full_sweep)
+            return None
+        if len(self.pending) > self.max_pending:
+            self.logger.info("%s tickets were left unfinished by the last run, making a full sweep", len(self.pending))
+            return None
+        window = now - self.parse_time(self.state['last_run']) + self.overlap
+        return int(math.ceil(window.total_seconds() / 60))
+
+    # Checks whether a ticket was handled by the last run and has not been updated since, e.g. a ticket populated but
+    # not progressed, whose own field updates would otherwise bring it back into the incremental search
+    #
+    def is_handled(self, key, updated):
+        handled_at = self.handled.get(key)
+        if handled_at is None or updated is None:
+            return False
+        try:
+            return self.parse_time(updated) <= handled_at + self.clock_skew
+        except ValueError:
+            return False
+
+    # Saves the watermark after a complete run, the run start time becomes the new watermark. Each handled ticket is
+    # recorded with the time its own writes finished. The unfinished tickets are kept as pending so that the next run
+    # searches them by key, whatever their update time
+    #
+    def save(self, run_start, full_sweep, source, handled, unfinished_keys):
+        if not self.enabled:
+            return
+        # keep earlier handled tickets that still fall inside the overlap of the next search window
+        kept = dict((key, handled_at) for key, handled_at in self.handled.items()
+                    if handled_at >= run_start - self.overlap)
+        kept.update(handled)
+        handled = kept
+        for key in unfinished_keys:
+            handled.pop(key, None)
+        pending = sorted(set(unfinished_keys))
+        state = {
+            "last_run":         self.format_time(run_start),
+            "last_full_sweep":  self.format_time(run_start) if full_sweep else self.state['last_full_sweep'],
+            "source":           source,
+            "handled":          dict((key, self.format_time(handled_at)) for key, handled_at in handled.items()),
+            "pending":          pending
+        }
+        temp_path = '{}.tmp'.format(self.path)
+        try:
+            with open(temp_path, 'w') as watermark_file:
+                json.dump(state, watermark_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            self.logger.warning("Unable to save watermark %s => %s", self.path, e)
+        else:
+            self.state = state
+            self.handled = handled
+            self.pending = pending
+            self.logger.info("Watermark saved, %s handled and %s pending ticket(s) recorded", len(handled),
+                             len(pending))
+
+    # Current time, timezone aware so that it compares with the Jira 'updated' timestamps
+    #
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc)
+
+    # Parse a Jira timestamp, e.g. 2019-10-01T10:00:00.000-0600
+    #
+    def parse_time(self, value):
+        return datetime.strptime(value, self.time_format)
+
+    def format_time(self, value):
+        return value.strftime(self.time_format)